@@ -1,7 +1,7 @@
 #!/usr/bin/python
 
 
-__all__ = ["screening_mgmt","examples", "aux_func"]
+__all__ = ["screening_mgmt","examples", "aux_func", "benchmark"]
 __version__ = "0.1.0"
 
 
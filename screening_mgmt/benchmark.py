@@ -0,0 +1,224 @@
+""" Benchmarks for the script 'screening_mgmt'.
+
+Generates a synthetic screening campaign in a file-backed SQLite database
+and measures batch_load(), write_results() and load_results(). For every
+stage, records/s, the number of SQL statements and the peak Python memory
+are reported and saved as JSON, so runs of different versions can be
+compared.
+
+Run from the package directory:
+
+    python benchmark.py --plates 50 --plate-size 384 --output bench.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import screening_mgmt as sm
+
+PLATE_SIZES = (96, 384, 1536)
+
+# Routine tables stay in the shared metadata, so every campaign run in the
+# same process needs its own aliases.
+_run_count = itertools.count()
+
+ROUTINE_TEMPLATE = '''
+import pandas
+
+def get_data(load_range=range(1, 11), newer_than=0, plate_size={plate_size}):
+    for plate in load_range:
+        wells = range(plate_size)
+        df = pandas.DataFrame({{
+            "Sample": ["cpd{{0}}".format((plate * plate_size + well) %
+                {compounds}) for well in wells],
+            "well": list(wells),
+            "value": [(plate + 1) * well % 97 / 97.0 for well in wells]}})
+        meta_values = {{
+            "user": "user{{0}}".format(plate % {users}),
+            "routine": "{alias}",
+            "date": "08.02.2016",
+            "active": 1}}
+        yield [df, meta_values]
+'''
+
+
+def _add_routine(db, alias, author):
+    db.new_entry(sm.Rtn, {'alias': alias, 'author': author,
+        'data_dimension': 1, 'script_path': None,
+        'data_fields': {'Sample': sm.Unicode(200), 'well': sm.Integer,
+            'value': sm.Float}})
+    db.refresh_schema()
+
+
+def _measure(db, records, func, *args, **kwargs):
+    """Run func and return its result and the statistics of the call.
+
+    records is the number of records processed, or a function computing it
+    from the result. If trace_memory is passed as True, only the peak
+    memory is measured, since tracing slows the call down.
+    """
+
+    trace_memory = kwargs.pop("trace_memory", False)
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            result = func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return result, {"peak_memory_kib": peak // 1024}
+
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    sm.sa.event.listen(db.engine, "before_cursor_execute", count)
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+        seconds = time.time() - start
+    finally:
+        sm.sa.event.remove(db.engine, "before_cursor_execute", count)
+    if callable(records):
+        records = records(result)
+    return result, {
+        "records": records,
+        "seconds": seconds,
+        "records_per_s": records / seconds if seconds else None,
+        "queries": statements[0]}
+
+
+def run_campaign(users=3, compounds=1000, routines=2, plate_size=384,
+        plates=10, sqlite_profile=False):
+    """Build a campaign database and benchmark the ingestion and query
+    stages.
+
+    :param int users: Number of users the plates are distributed over
+    :param int compounds: Size of the compound library
+    :param int routines: Number of routines, each reading every plate
+    :param int plate_size: Wells per plate (96, 384 or 1536)
+    :param int plates: Plates per routine (1-500)
+    :param bool sqlite_profile: Ingest with the SQLite ingest profile
+    :return: Configuration and statistics of every stage
+    :rtype: dict
+    """
+
+    if plate_size not in PLATE_SIZES:
+        raise ValueError("plate_size must be one of {0}".format(PLATE_SIZES))
+    if not 1 <= plates <= 500:
+        raise ValueError("plates must be between 1 and 500")
+    config = dict(users=users, compounds=compounds, routines=routines,
+        plate_size=plate_size, plates=plates, sqlite_profile=sqlite_profile)
+    # Timing and memory are measured in separate runs, so that tracing
+    # does not slow down the timed stages.
+    stages = _run_stages(config)
+    for name, stage in _run_stages(config, trace_memory=True).items():
+        stages[name].update(stage)
+    return {
+        "version": sm.__version__,
+        "python": platform.python_version(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": config,
+        "stages": stages}
+
+
+def _run_stages(config, trace_memory=False):
+    """Build a fresh campaign database for config and measure every stage,
+    see _measure()."""
+
+    users, compounds, routines, plate_size, plates, sqlite_profile = (
+        config[name] for name in ("users", "compounds", "routines",
+        "plate_size", "plates", "sqlite_profile"))
+    run = next(_run_count)
+    aliases = ["bench{0}_{1}".format(run, i) for i in range(routines)]
+    tmp = tempfile.mkdtemp()
+    usr_dir = os.path.join(tmp, "users")
+    script_dir = os.path.join(tmp, "scripts")
+    os.makedirs(usr_dir)
+    os.makedirs(script_dir)
+    stages = {}
+    try:
+        db = sm.DbConnection('sqlite', '', '', '', os.path.join(tmp,
+            'campaign.db'))
+        db._initialize()
+        for i in range(users):
+            db.new_entry(sm.Usr, {'usr_name': 'user{0}'.format(i),
+                'working_directory': usr_dir})
+        for alias in aliases:
+            _add_routine(db, alias, 'user0')
+            with open(os.path.join(script_dir, alias + ".py"), "w") as f:
+                f.write(ROUTINE_TEMPLATE.format(alias=alias, users=users,
+                    compounds=compounds, plate_size=plate_size))
+
+        cpd_file = os.path.join(tmp, "compounds.csv")
+        with open(cpd_file, "w") as f:
+            f.write("name,group\n")
+            for i in range(compounds):
+                f.write("cpd{0},group{1}\n".format(i, i % 10))
+        _, stages["batch_load"] = _measure(db, compounds, db.batch_load,
+            sm.Cpd, raw_file=cpd_file, trace_memory=trace_memory)
+
+        def write_all():
+            for alias in aliases:
+                db.write_results(alias, script_dir,
+                    load_range=range(plates), sqlite_profile=sqlite_profile)
+        _, stages["write_results"] = _measure(db,
+            routines * plates * plate_size, write_all,
+            trace_memory=trace_memory)
+
+        _, stages["load_results"] = _measure(db,
+            lambda result: sum(len(df) for df in result[0].values()),
+            db.load_results, "Rtn.alias IN ({0})".format(
+            ", ".join(repr(alias) for alias in aliases)),
+            trace_memory=trace_memory)
+        db.conn.close()
+    finally:
+        shutil.rmtree(tmp)
+    return stages
+
+
+def bench_sqlite_profile(plates=50, plate_size=384):
+    """Run the same campaign with and without the SQLite ingest profile and
+    return the write_results() records/s of both runs."""
+
+    return dict(
+        (name, run_campaign(plates=plates, plate_size=plate_size,
+            sqlite_profile=profile)["stages"]["write_results"]
+            ["records_per_s"])
+        for name, profile in (("default", False), ("sqlite_profile", True)))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument("--users", type=int, default=3)
+    arg_parser.add_argument("--compounds", type=int, default=1000)
+    arg_parser.add_argument("--routines", type=int, default=2)
+    arg_parser.add_argument("--plate-size", type=int, default=384,
+        choices=PLATE_SIZES)
+    arg_parser.add_argument("--plates", type=int, default=10)
+    arg_parser.add_argument("--sqlite-profile", action="store_true")
+    arg_parser.add_argument("--output", help="Save the results as JSON")
+    args = arg_parser.parse_args(argv)
+    result = run_campaign(args.users, args.compounds, args.routines,
+        args.plate_size, args.plates, args.sqlite_profile)
+    for name, stage in sorted(result["stages"].items()):
+        print ("{0:<14} {1:>10.0f} records/s {2:>8} queries {3:>10} KiB"
+            .format(name, stage["records_per_s"] or 0, stage["queries"],
+            stage["peak_memory_kib"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    return result
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
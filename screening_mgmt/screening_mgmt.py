@@ -16,8 +16,6 @@ Last revised: 08-02-2016
 
 
 """
-# uncomment these imports .
-'''
 import os
 import re
 import sys
@@ -26,7 +24,6 @@ import pandas
 import time
 import pickle
 from tkinter import ttk
-'''
 
 # import ttk
 # import tkMessageBox
@@ -36,6 +33,17 @@ from tkinter import simpledialog as tkSimpleDialog
 # import tkSimpleDialog
 import cmd
 import collections
+import concurrent.futures
+import contextlib
+import copy
+import datetime
+import hashlib
+import importlib.util
+import inspect
+import itertools
+import json
+import queue
+import threading
 import shutil
 import urllib
 
@@ -50,7 +58,7 @@ from tkinter import scrolledtext as ScrolledText
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import mapper
 from sqlalchemy import (Column, ForeignKey, String, Table, Boolean, Unicode,
-    Float, Integer, DateTime, PickleType, or_, Interval)
+    Float, Integer, DateTime, PickleType, or_, Interval, Text)
 
 
 __version__ = "1.0.0"
@@ -60,6 +68,17 @@ __docformat__ = "reStructuredText"
 
 Base = declarative_base()
 
+# Maximum number of values bound in a single IN clause
+_IN_CHUNK = 500
+
+# Settings of the SQLite ingest profile, see DbConnection.ingest_profile()
+SQLITE_INGEST_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -262144),  # Negative values are KiB, i.e. 256 MiB
+    ("mmap_size", 268435456),
+    )
+
 
 
 class DbError(Exception):
@@ -82,6 +101,755 @@ def _construct(**kwargs):
         setattr(self, key, kwargs[key])
 
 
+class IdCache(object):
+    """Bounded cache mapping names of compounds, users and routines to their
+    primary keys.
+
+    Entries are keyed by (table name, name). When the cache is full, the
+    least recently used entry is evicted.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        # Shared with the writer thread of background imports
+        self._lock = threading.Lock()
+
+    def get(self, table, name):
+        """Return the cached key, or None."""
+
+        with self._lock:
+            try:
+                key = self._data.pop((table, name))
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[(table, name)] = key
+            self.hits += 1
+            return key
+
+    def set(self, table, name, key):
+        """Store a key and evict the oldest entries if necessary."""
+
+        with self._lock:
+            self._data.pop((table, name), None)
+            self._data[(table, name)] = key
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, table=None, name=None):
+        """Drop one name, all names of one table or (default) everything."""
+
+        with self._lock:
+            if table is None:
+                self._data.clear()
+            elif name is None:
+                for entry in [e for e in self._data if e[0] == table]:
+                    del self._data[entry]
+            else:
+                self._data.pop((table, name), None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResultCache(object):
+    """Memory-bounded cache for the results of load_results().
+
+    Entries are keyed by the normalized filter and the column projection.
+    Every entry remembers the write versions of the tables it was read from;
+    writing to a table through the DbConnection bumps its version, which
+    makes the entries depending on it stale. Writes by other programs or
+    other connections are not noticed.
+
+    The cache holds entries of at most max_bytes in total, as reported by
+    the caller. It is disabled with max_bytes=0 (default), so results are
+    only cached on request; the GUI uses GUI_RESULT_CACHE_BYTES. When the
+    cache is full, the least recently used entries are evicted. If a
+    directory is given, evicted entries are pickled there as a second tier
+    of at most disk_size entries, for as long as the cache exists.
+    """
+
+    def __init__(self, max_bytes=0, directory=None, disk_size=200):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_size = disk_size
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._versions = {}
+        # Entries on disk from other sessions can not be validated
+        self._token = "{0}_{1}".format(os.getpid(), id(self))
+        self._lock = threading.Lock()
+
+    def bump(self, *tables):
+        """Increase the write version of tables."""
+
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def versions(self, tables):
+        """Return the current write versions of tables."""
+
+        with self._lock:
+            return dict((table, self._versions.get(table, 0))
+                for table in tables)
+
+    def get(self, key):
+        """Return the cached value, or None if it is missing or stale."""
+
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                entry = self._load(key)
+                if entry is not None:
+                    self.nbytes += entry[2]
+            if entry is not None and all(self._versions.get(table, 0) ==
+                    version for table, version in entry[0].items()):
+                self._data[key] = entry
+                self._evict()
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self.nbytes -= entry[2]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, versions, nbytes):
+        """Store value of nbytes, read at the given table versions. Values
+        larger than the cache are not stored."""
+
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
+            if nbytes > self.max_bytes:
+                return
+            self._data[key] = (versions, value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+
+    def clear(self):
+        """Drop all entries, also those on disk."""
+
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+            for path in self._files():
+                os.remove(path)
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            key, entry = self._data.popitem(last=False)
+            self.nbytes -= entry[2]
+            self._dump(key, entry)
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "{0}_{1}.pkl".format(
+            self._token, digest))
+
+    def _files(self):
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in
+            os.listdir(self.directory) if name.startswith(self._token)]
+
+    def _dump(self, key, entry):
+        if not self.directory:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(self._path(key), "wb") as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        files = sorted(self._files(), key=os.path.getmtime)
+        for path in files[:-self.disk_size or None]:
+            os.remove(path)
+
+    def _load(self, key):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (IOError, OSError, pickle.UnpicklingError):
+            return None
+        os.remove(path)
+        return entry
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Memory for cached query results in the GUI, see ResultCache
+GUI_RESULT_CACHE_BYTES = 256 * 2**20
+
+
+# Sample standard deviation by dialect, see aggregate_results()
+_STDDEV_FUNCTIONS = {
+    "mssql": "stdev",
+    "mysql": "stddev_samp",
+    "oracle": "stddev_samp",
+    "postgresql": "stddev_samp"}
+
+
+def _normalize_filter(filter_str):
+    """Remove insignificant whitespace outside of string literals from a
+    filter string."""
+
+    parts = re.split(r"""("[^"]*"|'[^']*')""", filter_str.strip())
+    return "".join(part if i % 2 else re.sub(r"\s+", " ",
+        re.sub(r"\s*([^\w\s])\s*", r"\1", part))
+        for i, part in enumerate(parts))
+
+
+# Tables that filters may refer to, see parse_filter()
+FILTER_TABLES = ("Cpd", "Usr", "Rtn", "Res")
+
+_FILTER_TOKEN = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")|
+    (?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)|
+    (?P<op>==|!=|<=|>=|<|>|\(|\)|,)|
+    (?P<word>[A-Za-z_][\w.]*))""", re.X)
+
+_FILTER_OPS = {
+    "==": lambda col, val: col == val,
+    "!=": lambda col, val: col != val,
+    "<=": lambda col, val: col <= val,
+    ">=": lambda col, val: col >= val,
+    "<": lambda col, val: col < val,
+    ">": lambda col, val: col > val}
+
+
+def _filter_tokens(filter_str):
+    """Split a filter string into (kind, value) tokens."""
+
+    tokens = []
+    pos = 0
+    filter_str = filter_str.rstrip()
+    while pos < len(filter_str):
+        match = _FILTER_TOKEN.match(filter_str, pos)
+        if match is None or match.end() == pos:
+            raise DbError("Could not create filter\n{0}\n".format(filter_str)
+                + "Unexpected character at position {0}.".format(pos))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = value[1:-1].replace(value[0] * 2, value[0])
+        elif kind == "number":
+            value = float(value) if set(value) & set(".eE") else int(value)
+        elif kind == "word" and value.upper() in ("AND", "OR", "NOT", "IN",
+                "LIKE"):
+            kind, value = "op", value.upper()
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+def filter_field(name):
+    """Return the column attribute for a field name like 'Cpd.name'."""
+
+    try:
+        table, column = name.split(".")
+        cls = globals()[table] if table in FILTER_TABLES else None
+        if column not in cls.__table__.columns:
+            raise KeyError(column)
+    except (ValueError, KeyError, AttributeError):
+        raise DbError("Unknown field '{0}'. Fields have the form ".format(name)
+            + "<table>.<column>, with table one of {0}.".format(
+            ", ".join(FILTER_TABLES)))
+    return getattr(cls, column)
+
+
+class _FilterParser(object):
+    """Recursive descent parser for parse_filter()."""
+
+    def __init__(self, filter_str):
+        self.filter_str = filter_str
+        self.tokens = _filter_tokens(filter_str)
+        self.pos = 0
+
+    def error(self, message):
+        raise DbError("Could not create filter\n{0}\n{1}".format(
+            self.filter_str, message))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self, kind, value=None):
+        token = self.peek()
+        if token[0] != kind or (value is not None and token[1] != value):
+            self.error("Expected {0}, found {1}.".format(value or kind,
+                token[1] if token[0] else "end of filter"))
+        self.pos += 1
+        return token[1]
+
+    def parse(self):
+        if not self.tokens:
+            return sa.true()
+        criterion = self.expression()
+        if self.peek()[0] is not None:
+            self.error("Unexpected '{0}'.".format(self.peek()[1]))
+        return criterion
+
+    def expression(self):
+        terms = [self.term()]
+        while self.peek() == ("op", "OR"):
+            self.pos += 1
+            terms.append(self.term())
+        return terms[0] if len(terms) == 1 else sa.or_(*terms)
+
+    def term(self):
+        factors = [self.factor()]
+        while self.peek() == ("op", "AND"):
+            self.pos += 1
+            factors.append(self.factor())
+        return factors[0] if len(factors) == 1 else sa.and_(*factors)
+
+    def factor(self):
+        if self.peek() == ("op", "("):
+            self.pos += 1
+            criterion = self.expression()
+            self.take("op", ")")
+            return criterion
+        col = filter_field(self.take("word"))
+        kind, op = self.peek()
+        self.pos += 1
+        if op == "NOT":
+            self.take("op", "IN")
+            return ~col.in_(self.values(col))
+        if op == "IN":
+            return col.in_(self.values(col))
+        if op == "LIKE":
+            return col.like(self.value())
+        if kind == "op" and op in _FILTER_OPS:
+            return _FILTER_OPS[op](col, self.value(col))
+        self.error("Expected a comparison after '{0}'.".format(col))
+
+    def value(self, col=None):
+        kind, value = self.peek()
+        if kind not in ("string", "number"):
+            self.error("Expected a value, found {0}.".format(
+                value if kind else "end of filter"))
+        self.pos += 1
+        if col is not None and isinstance(col.type, DateTime)\
+                and kind == "string":
+            # Dates are compared as dates, not as strings
+            try:
+                value = parser.parse(value)
+            except (ValueError, OverflowError):
+                self.error("'{0}' is not a date.".format(value))
+        return value
+
+    def values(self, col=None):
+        self.take("op", "(")
+        values = [self.value(col)]
+        while self.peek() == ("op", ","):
+            self.pos += 1
+            values.append(self.value(col))
+        self.take("op", ")")
+        return values
+
+
+def parse_filter(filter_str):
+    """
+    Parse a filter string into an SQLAlchemy expression.
+
+    Criteria have the form <field> <operator> <value>, where field is
+    <table>.<column> with table one of Cpd, Usr, Rtn or Res, operator one of
+    ==, !=, <=, >=, <, >, LIKE, IN or NOT IN and value a quoted string or a
+    number. IN and NOT IN take a list of values in parentheses. Criteria are
+    combined with AND and OR (AND binds stronger) and can be grouped with
+    parentheses. Values are sent as bound parameters. An empty filter
+    matches everything. Values compared to dates (Res.date) are parsed as
+    dates.
+
+    :param str filter_str: The filter string
+    :return: The filter expression
+    :raises DbError: If the filter string is not valid
+
+    >>> parse_filter("Cpd.name LIKE '%ol' AND (Usr.usr_name IN ('ah', 'bk')"
+    ...     " OR Rtn.alias == 'ic50')")
+    """
+
+    return _FilterParser(filter_str).parse()
+
+
+def compact_frame(df, categories=("Sample",)):
+    """
+    Convert a data frame to memory-saving dtypes.
+
+    Integer columns get the smallest integer dtype, float columns become
+    float32 if no value changes by it. The columns in categories (by default
+    the compound names) and text columns where at most half of the values
+    are distinct become categoricals.
+
+    :param pandas.DataFrame df: The data frame, it is modified in place
+    :param tuple categories: Columns that are always made categorical
+    :return: df
+    :rtype: pandas.DataFrame
+    """
+
+    for name in df.columns:
+        col = df[name]
+        if col.dtype.kind in "iu":
+            df[name] = pandas.to_numeric(col, downcast="integer")
+        elif col.dtype.kind == "f":
+            narrow = col.astype("float32")
+            if ((narrow == col) | col.isnull()).all():
+                df[name] = narrow
+        elif col.dtype.kind == "O":
+            if name in categories or col.nunique() <= len(col) // 2:
+                df[name] = col.astype("category")
+    return df
+
+
+def _arrow():
+    """Import pyarrow, which is only needed for exports."""
+
+    try:
+        import pyarrow
+    except ImportError:
+        raise DbError("Exporting results needs the package 'pyarrow'.")
+    return pyarrow
+
+
+def _arrow_schema(pa, table, columns):
+    """Replace the null types that Arrow infers for columns without values
+    by the types of the database columns, {name: Column}."""
+
+    fields = []
+    for field in table.schema:
+        if pa.types.is_null(field.type) and field.name in columns:
+            col_type = columns[field.name].type
+            if isinstance(col_type, Boolean):
+                field = field.with_type(pa.bool_())
+            elif isinstance(col_type, Integer):
+                field = field.with_type(pa.int64())
+            elif isinstance(col_type, sa.Numeric):
+                field = field.with_type(pa.float64())
+            elif isinstance(col_type, DateTime):
+                field = field.with_type(pa.timestamp("us"))
+            else:
+                field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+
+def read_export(path, columns=None):
+    """
+    Read a routine file written by DbConnection.export_results().
+
+    The file is memory-mapped, so only the requested columns are read from
+    disk. Files written without compression are not copied at all.
+
+    :param str path: Path of the .arrow file
+    :param list columns: Columns to read, default all
+    :return: The results, with the export information in df.attrs
+    :rtype: pandas.DataFrame
+    """
+
+    _arrow()
+    from pyarrow import feather
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    df = table.to_pandas()
+    meta = (table.schema.metadata or {}).get(b"screening_mgmt")
+    if meta:
+        df.attrs.update(json.loads(meta.decode("utf-8")))
+    return df
+
+
+def _date_range(filter_str, since=None, until=None):
+    """Restrict filter_str to results with since <= Res.date < until.
+
+    since and until are datetime objects or date strings, None leaves the
+    range open.
+    """
+
+    criteria = ["({0})".format(filter_str)] if filter_str.strip() else []
+    for comp, date in ((">=", since), ("<", until)):
+        if date is not None:
+            criteria.append(_filter_criterion("Res.date", comp, str(date)))
+    return " AND ".join(criteria)
+
+
+def _filter_criterion(field, comp, value):
+    """Format one criterion of the query builder, see parse_filter().
+
+    Values of IN and NOT IN are separated by ', ', LIKE matches value
+    anywhere in the field.
+    """
+
+    def quote(value):
+        return "'{0}'".format(value.replace("'", "''"))
+
+    if comp in ("IN", "NOT IN"):
+        return "{0} {1} ({2})".format(field, comp,
+            ", ".join(quote(v) for v in value.split(", ")))
+    if comp == "LIKE":
+        value = "%{0}%".format(value)
+    return "{0} {1} {2}".format(field, comp, quote(value))
+
+
+class RoutineRegistry(object):
+    """Routine scripts, loaded by file path.
+
+    Modules are cached and executed again only when the modification time or
+    size of the file changed and its content hash differs. sys.path and
+    sys.modules are not touched.
+    """
+
+    def __init__(self):
+        self._modules = {}
+        # Shared with the writer thread of background imports
+        self._lock = threading.Lock()
+
+    def get(self, routine, directory):
+        """Return the module of the script <directory>/<routine>.py.
+
+        :raises ImportError: If there is no such script
+        :raises SyntaxError: If the script is not valid Python
+        """
+
+        if not routine or not directory:
+            raise ImportError("No routine script given")
+        return self.load(os.path.join(directory, routine + ".py"))
+
+    def load(self, path):
+        """Return the module of the script at path, see get()."""
+
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise ImportError("No routine script '{0}'".format(path))
+        stamp = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._modules.get(path)
+            if entry is not None and entry[0] == stamp:
+                return entry[2]
+            with open(path, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            if entry is not None and entry[1] == digest:
+                # Touched, but not changed
+                self._modules[path] = (stamp, digest, entry[2])
+                return entry[2]
+            name = os.path.splitext(os.path.basename(path))[0]
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self._modules[path] = (stamp, digest, module)
+            return module
+
+    def __len__(self):
+        return len(self._modules)
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    """Stop pysqlite from handling transactions itself."""
+
+    dbapi_connection.isolation_level = None
+
+
+def _sqlite_begin(conn):
+    """Start SQLite transactions explicitly."""
+
+    conn.execute("BEGIN")
+
+
+class IngestJob(object):
+    """Handle of a background import, see DbConnection.submit_results().
+
+    datasets and rows count what has been written so far, errors collects
+    the messages of data sets that could not be written.
+    """
+
+    def __init__(self, routine):
+        self.routine = routine
+        self.datasets = 0
+        self.rows = 0
+        self.errors = []
+        self.cancelled = False
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        """True when the job has finished, failed or was cancelled."""
+
+        return self._done.is_set()
+
+    def cancel(self):
+        """Stop the job after the current data set."""
+
+        self.cancelled = True
+
+    def wait(self, timeout=None):
+        """Block until the job is done. Return False on timeout."""
+
+        return self._done.wait(timeout)
+
+    def __repr__(self):
+        state = "done" if self.done else "running"
+        if self.cancelled:
+            state = "cancelled"
+        return "<IngestJob '{0}' {1}: {2} data sets, {3} rows, {4} errors>"\
+            .format(self.routine, state, self.datasets, self.rows,
+            len(self.errors))
+
+
+def _report(job, message):
+    """Print message and add it to the errors of job, if there is one."""
+
+    print (message)
+    if job is not None:
+        job.errors.append(message)
+
+
+def _get_datasets(rtn, workers, args, kwargs):
+    """Return an iterator over the data sets of the routine module rtn.
+
+    Errors raised by get_data() are passed on. A return value that is not
+    iterable is returned as the only data set, so that the format check
+    reports it.
+    """
+
+    if workers > 1:
+        return _parallel_get_data(rtn, workers, args, kwargs)
+    sets = rtn.get_data(*args, **kwargs)
+    try:
+        return iter(sets)
+    except TypeError:
+        return iter([sets])
+
+
+def _is_dataset(dataset):
+    """Check that dataset is a [DataFrame, dict] pair as returned by
+    get_data()."""
+
+    return (isinstance(dataset, (list, tuple)) and len(dataset) == 2
+        and isinstance(dataset[0], pandas.DataFrame)
+        and isinstance(dataset[1], dict))
+
+
+# Scripts loaded in a worker process of _parallel_get_data()
+_worker_routines = RoutineRegistry()
+
+
+def _run_get_data(script, load_range, args, kwargs):
+    """Import the routine script and run get_data() for one shard of
+    load_range. Runs in a worker process, so it returns a list.
+    """
+
+    rtn = _worker_routines.load(script)
+    return list(rtn.get_data(*args, load_range=load_range, **kwargs) or [])
+
+
+def _render_plot(script, df, path, args, kwargs):
+    """Run summarize_plot() of the routine script and save the figure to
+    path. Runs in a worker process with the non-interactive Agg backend.
+    """
+
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot
+
+    rtn = _worker_routines.load(script)
+    plot = rtn.summarize_plot(df, *args, **kwargs)
+    # summarize_plot() may return a figure, axes or pyplot itself
+    fig = plot.get_figure() if hasattr(plot, "get_figure") else plot
+    if not hasattr(fig, "savefig"):
+        fig = pyplot.gcf()
+    fig.savefig(path, bbox_inches="tight")
+    pyplot.close("all")
+    return path
+
+
+def _parallel_get_data(rtn, workers, args, kwargs):
+    """Split load_range of get_data() into shards and run them in a pool of
+    worker processes.
+
+    Data sets are yielded shard by shard as the workers finish. At most two
+    shards per worker are pending, and the data sets of a shard are released
+    once they are yielded, so memory does not grow with load_range. If the
+    routine takes no load_range, get_data() is run in this process.
+    """
+
+    kwargs = dict(kwargs)
+    load_range = kwargs.pop("load_range", None)
+    if load_range is None:
+        param = inspect.signature(rtn.get_data).parameters.get("load_range")
+        if param is None or param.default is param.empty:
+            for dataset in rtn.get_data(*args, **kwargs) or []:
+                yield dataset
+            return
+        load_range = param.default
+    load_range = list(load_range)
+    # Several shards per worker keep the pool busy if plates differ in size
+    size = max(1, -(-len(load_range) // (workers * 4)))
+    shards = (load_range[i:i + size] for i in range(0, len(load_range), size))
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = set(pool.submit(_run_get_data, rtn.__file__, shard, args,
+            kwargs) for shard in itertools.islice(shards, workers * 2))
+        while pending:
+            done, pending = concurrent.futures.wait(pending,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            while done:
+                future = done.pop()
+                # Errors of get_data() are passed on, as in this process
+                datasets = future.result()
+                del future
+                for shard in itertools.islice(shards, 1):
+                    pending.add(pool.submit(_run_get_data, rtn.__file__,
+                        shard, args, kwargs))
+                datasets.reverse()
+                while datasets:
+                    yield datasets.pop()
+
+
+def _parse_date(date):
+    """Convert the date of a data set to a datetime object.
+
+    Numbers are interpreted as Excel dates, strings are parsed with dateutil.
+    Unparseable strings return 0.
+    """
+
+    if isinstance(date, (int, float)):
+        xld = xlrd.xldate_as_tuple(date, 1)
+        date = "{2}.{1}.{0}".format(*xld)
+        return parser.parse(date, dayfirst=True, fuzzy=True)
+    try:
+        return parser.parse(date)
+    except ValueError:
+        return 0
+
+
+def _parse_columns(text):
+    """Parse a column projection like 'rtn1: col1, col2; rtn2: col3'.
+
+    :return: {routine: [column names]}
+    :rtype: dict
+    """
+
+    columns = {}
+    for part in text.split(";"):
+        if not part.strip():
+            continue
+        try:
+            routine, names = part.split(":", 1)
+        except ValueError:
+            raise DbError("Columns must be given as 'routine: col1, col2'")
+        columns[routine.strip()] = [name.strip() for name in
+            names.split(",") if name.strip()]
+    return columns
+
+
 class DbConnection(object):
     """
     Interface to the database connection.
@@ -135,6 +903,17 @@ class DbConnection(object):
             self.driver = ""
         self.key_val = key_val
         self.status = False
+        self.id_cache = IdCache()
+        self.result_cache = ResultCache()
+        self.routines = RoutineRegistry()
+        # Parsed filters and select statements by normalized filter, and
+        # their compiled forms
+        self._statements = sa.util.LRUCache(200)
+        self._compiled = sa.util.LRUCache(200)
+        self.schema_version = 0
+        self._reflected_version = None
+        self._jobs = queue.Queue()
+        self._writer = None
 
     def _initialize(self):
         """
@@ -148,13 +927,50 @@ class DbConnection(object):
             except (DbError, e):
                 print (e)
         if self.status:
-            for tb in [Usr, Cpd, Rtn, Res]:
+            for tb in [Usr, Cpd, Rtn, Res, Qtn, Raw]:
                 tb.__table__
             self.metadata = Base.metadata
             self.metadata.create_all(self.engine)
+            self._reflected_version = None
         else:
             raise DbError("Could not establish connection to the database.")
 
+    def ensure_indexes(self):
+        """
+        Add missing indexes to an existing database.
+
+        Databases created by older versions lack the indexes on the result
+        columns sample, user, routine and date and on the link column of the
+        routine tables, which are used by every query, and the index on path
+        and routine of the raw data fingerprints.
+
+        :return: Names of the created indexes
+        :rtype: list
+        """
+
+        self.refresh_schema(force=True)
+        inspector = sa.inspect(self.engine)
+        wanted = [("results", col) for col in ("sample", "user", "routine",
+            "date")]
+        wanted.append(("raw_data", "path"))
+        wanted += [(alias, "link") for alias, in self.session.query(Rtn.alias)]
+        created = []
+        for table, column in wanted:
+            if table not in self.metadata.tables:
+                continue
+            if any(index["column_names"][:1] == [column] for index in
+                    inspector.get_indexes(table)):
+                continue
+            tbl = self.metadata.tables[table]
+            name = "ix_{0}_{1}".format(table, column)
+            index = ([i for i in tbl.indexes if i.name == name] or
+                [sa.Index(name, tbl.c[column])])[0]
+            index.create(self.engine)
+            created.append(name)
+        if created:
+            self.schema_changed()
+        return created
+
     def _close_connection(self):
         """
         Close the connection.
@@ -195,6 +1011,15 @@ class DbConnection(object):
         except (sa.exc.ArgumentError, e):
             raise DbError("> The URL\n\n{0}\n\n is not valid.\n\n> {1}"
                 .format(url, e))
+        # pysqlite handles transactions itself, which breaks the savepoints
+        # used for ingestion; let SQLAlchemy emit BEGIN instead. An
+        # in-memory database has one connection, shared with the session,
+        # so the whole engine is switched. With a file, only conn is, and
+        # the reads of the session do not hold locks against it.
+        memory = self.dialect == "sqlite" and self.database == ":memory:"
+        if memory:
+            sa.event.listen(self.engine, "connect", _sqlite_connect)
+            sa.event.listen(self.engine, "begin", _sqlite_begin)
         try:
             self.conn = self.engine.connect()
         except (sa.exc.DBAPIError, e):  # Wrong password, user or server
@@ -202,7 +1027,11 @@ class DbConnection(object):
                 "> Check password, user name or server.\n\n> {0}".format(e))
         except (sa.exc.ProgrammingError, e) :  # Wrong database
             raise DbError("> Check database name.\n\n> {0}".format(e))
+        if self.dialect == "sqlite" and not memory:
+            _sqlite_connect(self.conn.connection.connection, None)
+            sa.event.listen(self.conn, "begin", _sqlite_begin)
         self.metadata = sa.MetaData(bind=self.engine)
+        self._reflected_version = None
         Session = sa.orm.sessionmaker(bind=self.engine)
         self.session = Session()
         self.status = True
@@ -222,10 +1051,14 @@ class DbConnection(object):
             'compound_name': 'cpd123', 'MW': 154.2})
         """
 
-        self.metadata.reflect(self.engine)
+        self.refresh_schema()
         entry = target(self, **data)
         self.session.add(entry)
         self.session.commit()  # To do: Catch exceptions
+        self.result_cache.bump(target.__tablename__)
+        if hasattr(target, "_name_field"):
+            self.id_cache.invalidate(target.__tablename__,
+                data.get(target._name_field))
 
     def batch_load(self, target, delim=",", raw_file=None, update=False):
         """
@@ -240,15 +1073,15 @@ class DbConnection(object):
                 the new data; if False the new records are ignored.
         """
 
-        if isinstance(target, basestring):
+        if isinstance(target, str):
             target = eval(target)
+        self.refresh_schema()
         if target == Cpd:
             id_field = "name"
             table = self.metadata.tables['compounds']
         elif target == Usr:
             id_field = "usr_name"
             table = self.metadata.tables['users']
-        self.metadata.reflect(self.engine)
         if not raw_file:
             raw_file = tkfd.askopenfilename(filetypes=[
                 ('All files', '.*'),
@@ -318,18 +1151,104 @@ class DbConnection(object):
                     "xls, xlsx, txt, csv.")
                 return
             self.session.commit()
+            self.id_cache.invalidate(target.__tablename__)
+            self.result_cache.bump(target.__tablename__)
+
+    @contextlib.contextmanager
+    def ingest_profile(self, pragmas=SQLITE_INGEST_PRAGMAS):
+        """
+        Tune a SQLite connection for bulk writes.
+
+        Within the block, the ingest connection uses WAL journaling, a relaxed
+        synchronous level, a larger page cache and memory-mapped I/O. The
+        previous settings are restored on exit. For other dialects, this does
+        nothing.
+
+        :param pragmas: (name, value) pairs of the PRAGMAs to set
 
-    def write_results(self, routine, user_dir, preview=False, *args, **kwargs):
+        >>> with DbConnection.ingest_profile():
+        ...     DbConnection.write_results('load_data', 'users/')
+        """
+
+        if self.dialect != "sqlite":
+            yield
+            return
+        previous = []
+        for name, value in pragmas:
+            previous.append((name, self.conn.execute(
+                "PRAGMA {0}".format(name)).scalar()))
+            self.conn.execute("PRAGMA {0} = {1}".format(name, value))
+        try:
+            yield
+        finally:
+            for name, value in reversed(previous):
+                if value is None:
+                    continue
+                try:
+                    self.conn.execute("PRAGMA {0} = {1}".format(name, value))
+                except sa.exc.OperationalError as e:
+                    print ("Could not reset PRAGMA {0}: {1}".format(name, e))
+
+    def refresh_schema(self, force=False):
+        """
+        Bring the table definitions in the metadata up to date.
+
+        The database is only reflected if the schema version changed since
+        the last reflection, i.e. after a routine table was created or
+        altered, or if force is True.
+
+        :param bool force: Reflect the database in any case, e.g. after the
+                schema was changed by another program.
+        """
+
+        if force or self._reflected_version != self.schema_version:
+            self.metadata.reflect(self.engine)
+            self._reflected_version = self.schema_version
+        self.metadata.bind = self.engine
+
+    def schema_changed(self):
+        """
+        Mark the cached schema as outdated after a table was created, altered
+        or dropped.
+        """
+
+        self.schema_version += 1
+        self.result_cache.clear()
+        self._statements.clear()
+        self._compiled.clear()
+
+    def write_results(self, routine, user_dir, preview=False, *args,
+            chunk_size=1000, workers=1, incremental=True, sqlite_profile=False,
+            **kwargs):
         """
         Run routine and write the results into the main table.
 
         The function loads the user scripts from the user's working directory.
+        get_data() may return a list or any other iterable of
+        [DataFrame, dict] pairs, e.g. a generator. Data sets are written as
+        they arrive, so only one of them needs to be held in memory.
+        If the meta values of a data set name its source file as 'raw_file',
+        the file is fingerprinted (path, size, mtime and SHA-1 hash) and
+        stored as raw_data_id of the results. Data sets from files that were
+        already ingested unchanged are skipped; if a file has changed, the
+        results of its earlier versions are deactivated.
 
         :param str routine: Python script for data import (without file
                 extension). The file must be saved in the user directory.
         :param str user_dir: Directory of the routine script
         :param bool preview: Whether or not to show a preview of the data
                 before writing them to the database
+        :param int chunk_size: Number of records written per statement
+                batch. Records that cannot be written are moved to the
+                quarantine table, see reingest_quarantine().
+        :param int workers: Number of processes running get_data(). If more
+                than one, load_range is split into shards that are read in
+                parallel, while the database is written from this process.
+        :param bool incremental: Skip data sets whose raw file was already
+                ingested unchanged (default). If False, they are written
+                again.
+        :param bool sqlite_profile: Write with the SQLite ingest profile, see
+                ingest_profile().
         :param args, kwargs: Optional arguments for the routine script
         :return: True in case of success, otherwise false.
         :rtype: bool
@@ -340,10 +1259,116 @@ class DbConnection(object):
 
         """
 
-        declined_rtn = []
-        sys.path.append(user_dir)
+        if sqlite_profile:
+            with self.ingest_profile():
+                return self.write_results(routine, user_dir, preview, *args,
+                    chunk_size=chunk_size, workers=workers,
+                    incremental=incremental, **kwargs)
+        rtn, script_path = self._import_routine(routine, user_dir)
+        if rtn is None:
+            return False
+        # get_data() may return a list or a generator. Data sets are
+        # written as they arrive, only the first one is held back for
+        # the format check and the preview.
+        sets = _get_datasets(rtn, workers, args, kwargs)
+        first = next(sets, None)
+        if not _is_dataset(first):
+            tkMessageBox.showerror("Structural error",
+                    "Wrong format returned from 'get_data()'")
+            return False
+        if preview:
+            root = tk.Tk()
+            d = PreviewDialog(root, first[0].head())
+            root.wait_window(d.top)
+            if not d.result:
+                root.destroy()
+                return False
+            else:
+                root.destroy()
+
+        sets = itertools.chain([first], sets)
+        del first
+        self._ingest(sets, script_path, chunk_size, incremental)
+        return True
+
+    def submit_results(self, routine, user_dir, *args, chunk_size=1000,
+            workers=1, incremental=True, **kwargs):
+        """
+        Queue an import and return immediately.
+
+        The routine script is loaded right away, get_data() and the database
+        writes run in a background thread with its own connection. Jobs are
+        processed one after the other. Unlike write_results(), there is no
+        preview, and data sets of unknown routines are skipped instead of
+        offered for creation.
+
+        :param str routine: Python script for data import (without file
+                extension). The file must be saved in the user directory.
+        :param str user_dir: Directory of the routine script
+        :param args, kwargs: Optional arguments for the routine script and
+                chunk_size, workers and incremental as in write_results()
+        :return: Handle of the job, or None if the script was not loaded
+        :rtype: IngestJob
+
+        >>> job = DbConnection.submit_results('load_data', 'users/')
+        >>> job.wait()
+        >>> print job.rows, job.errors
+        """
+
+        if self.dialect == "sqlite" and self.database == ":memory:":
+            raise DbError("Background imports need a database file.")
+        rtn, script_path = self._import_routine(routine, user_dir)
+        if rtn is None:
+            return None
+        job = IngestJob(routine)
+        self._jobs.put((job, rtn, script_path, args, kwargs, {
+            "chunk_size": chunk_size, "workers": workers,
+            "incremental": incremental}))
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._drain_jobs,
+                name="screening_mgmt writer")
+            self._writer.daemon = True
+            self._writer.start()
+        return job
+
+    def _drain_jobs(self):
+        """
+        Process the queued imports. Runs in the writer thread with its own
+        connection and session, sharing the id cache.
+        """
+
+        writer = copy.copy(self)
+        writer.connect()
+        while True:
+            job, rtn, script_path, args, kwargs, options = self._jobs.get()
+            try:
+                if not job.cancelled:
+                    sets = _get_datasets(rtn, options["workers"], args,
+                        kwargs)
+                    writer._ingest(sets, script_path, options["chunk_size"],
+                        options["incremental"], job=job)
+            except Exception as e:
+                _report(job, "Import of '{0}' failed: {1}".format(
+                    job.routine, e))
+            finally:
+                job._done.set()
+                self._jobs.task_done()
+
+    def _import_routine(self, routine, user_dir):
+        """
+        Import the routine script, asking the user for it if it cannot be
+        found.
+
+        :return: (module, script_path), where script_path is the (directory,
+                file name) chosen by the user or None. (None, None) if no
+                valid script was loaded.
+        :rtype: tuple
+        """
+
+        script_path = None
+        file_ = routine
         try:
-            exec("import {0} as rtn".format(routine)) in locals()
+            rtn = self.routines.get(routine, user_dir)
         except ImportError:
             if routine:
                 errortext = ("""Module '{0}' not found in '{1}'\n.
@@ -358,174 +1383,899 @@ class DbConnection(object):
                 except ValueError:
                     path, file_ = loc.rsplit("/", 1)
                 file_, _ = file_.rsplit(".",1)
-                sys.path.append(path)
+                script_path = (path, file_)
                 try:
-                    exec("import {0} as rtn".format(file_)) in locals()
+                    rtn = self.routines.load(loc)
                 except ImportError:
                     tkMessageBox.showerror("Import error",
                         "The script '{0}' is not valid.".format(file_))
+                    return None, None
             else:
-                return False
+                return None, None
         if not hasattr(rtn, 'get_data'):
             tkMessageBox.showerror("Function not found",
                 "The script '{0}' has no function 'get_data()'\n".format(file_) +
                 "Please modify your script accordingly.")
+            return None, None
+        return rtn, script_path
+
+    def _ingest(self, sets, script_path=None, chunk_size=1000,
+            incremental=True, job=None):
+        """
+        Write data sets to the database.
+
+        :param sets: Iterable of [DataFrame, dict] pairs
+        :param tuple script_path: (directory, file name) of the routine
+                script, used when a routine is created automatically
+        :param int chunk_size: Number of records per statement batch
+        :param bool incremental: Skip raw files that were already ingested
+        :param IngestJob job: Background job to report progress and errors
+                to. Jobs are not interactive, so unknown routines are skipped.
+                The job is checked for cancellation after every data set.
+        :return: Number of records written
+        :rtype: int
+        """
+
+        declined_rtn = []
+        raw_files = {}
+        written = 0
+        for dataset in sets:
+            if job is not None and job.cancelled:
+                break
+            if not _is_dataset(dataset):
+                _report(job, "Wrong format returned from 'get_data()', " +
+                    "data set skipped.")
+                continue
+            meta_values = dataset[1]
+            df = dataset[0]
+            self.refresh_schema()
+            if meta_values['routine'] not in self.metadata.tables:
+                if job is not None:
+                    # The routine may have been created by another connection
+                    self.refresh_schema(force=True)
+                    if meta_values['routine'] not in self.metadata.tables:
+                        _report(job, "Unknown routine '{0}', data set "
+                            "skipped.".format(meta_values['routine']))
+                        continue
+                elif not self._add_routine(meta_values['routine'], df,
+                        meta_values['user'], script_path,
+                        declined_rtn):
+                    continue
+            raw = None
+            if meta_values.get('raw_file'):
+                path = meta_values['raw_file']
+                if path not in raw_files:
+                    raw_files[path] = self._fingerprint(path,
+                        meta_values['routine'])
+                    if raw_files[path] and raw_files[path]['ingested']\
+                            and incremental:
+                        print ("'{0}' is unchanged, skipped.".format(path))
+                raw = raw_files[path]
+                if raw is not None and raw['ingested'] and incremental:
+                    continue
+            try:
+                rows = self._bulk_insert(df, meta_values,
+                    chunk_size=chunk_size, raw=raw)
+            except (sa.exc.SQLAlchemyError, DbError) as e:
+                _report(job, "Could not write data set\n{0}\nto Database. "
+                    "Error {1}".format(meta_values, e))
+                continue
+            written += rows
+            if job is not None:
+                job.datasets += 1
+                job.rows += rows
+        self.metadata.create_all(bind=self.engine, checkfirst=True)
+        return written
+
+    def _add_routine(self, alias, df, author, script_path, declined_rtn):
+        """
+        Offer to create a routine that is unknown to the database.
+
+        The columns of the routine table are derived from the dtypes of df.
+
+        :param str alias: Short name of the missing routine
+        :param pandas.DataFrame df: Data set whose columns define the table
+        :param str author: User name of the routine author
+        :param tuple script_path: (directory, file name) of the routine
+                script, or None
+        :param list declined_rtn: Routines the user refused to create. Is
+                extended if the user declines again.
+        :return: True if the routine was created
+        :rtype: bool
+        """
+
+        if alias in declined_rtn:
             return False
-        else:
-            sets = (rtn.get_data(*args, **kwargs))
-            struct = False
-            if sets:
-                if isinstance(sets, list):
-                    if isinstance(sets[0], list):
-                        if isinstance(sets[0][0], pandas.DataFrame)\
-                        and isinstance(sets[0][1], dict):
-                            struct = True
-            if not struct:
-                tkMessageBox.showerror("Structural error",
-                        "Wrong format returned from 'get_data()'")
-                return False
-            if preview:
-                root = tk.Tk()
-                d = PreviewDialog(root, sets[0][0].head())
-                root.wait_window(d.top)
-                if not d.result:
-                    root.destroy()
-                    return False
-                else:
-                    root.destroy()
-
-            for dataset in sets:
-                meta_values = dataset[1]
-                df = dataset[0]
-                for record in df.to_dict(outtype="records"):
-                    meta_values['sample'] = record['Sample']
-                    current_record = Res(self, meta_values)
-                    self.session.add(current_record)
-                    self.metadata.reflect(self.engine)
-                    self.metadata.bind = self.engine
-                    try:
-                        self.session.commit()
-                        record['link'] = current_record.res_id
-                        self.metadata.tables[meta_values['routine']]\
-                            .insert(values=record).execute()
-
-                    except (KeyError, e ):
-                        e_str = str(e)
-                        e_str = e_str.replace("'", "")
-                        e_str = e_str.replace('"', '')
-                        if e_str not in declined_rtn:
-                            dialog = tkMessageBox.askyesno("Unknown routine",
-                                "Would you like to automatically add the " +
-                                "routine '{0}'?".format(e_str))
-                            if dialog:
-                                d_fields = {}
-                                for keys in df.columns:
-                                    if df[keys].dtypes == "bool":
-                                        d_type = Boolean
-                                    elif df[keys].dtypes in ["int16",
-                                        "uint32"]:
-                                        d_type = Integer
-                                    elif df[keys].dtypes in ["float32",
-                                        "float64"]:
-                                        d_type = Float(precision=25)
-                                    elif df[keys].dtypes == "cfloat":
-                                        d_type = Unicode(50)
-                                    elif df[keys].dtypes == "datetime64":
-                                        d_type = DateTime
-                                    elif df[keys].dtypes == "timedelta64":
-                                        d_type = Interval
-                                    #if isinstance(dataset[0], (int, long, float)):
-                                    #    d_type = Float(precision=20)
-                                    else:
-                                        d_type = Unicode(200)
-
-                                    d_fields[keys] = d_type
-
-                                values = {"alias": e_str,
-                                    "full_name": e_str,
-                                    "data_dimension": 1,
-                                    "author": meta_values["user"],
-                                    "data_fields": d_fields,
-                                    "script_path": (path, file_)}
-
-                                self.new_entry(Rtn, values)
-
-                                self.metadata.reflect(self.engine)
-                                self.session.commit()
-                                record['link'] = current_record.res_id
-                                self.metadata.tables[meta_values['routine']]\
-                                    .insert(values=record).execute()
+        dialog = tkMessageBox.askyesno("Unknown routine",
+            "Would you like to automatically add the " +
+            "routine '{0}'?".format(alias))
+        if not dialog:
+            declined_rtn.append(alias)
+            return False
+        d_fields = {}
+        for keys in df.columns:
+            if df[keys].dtypes == "bool":
+                d_type = Boolean
+            elif df[keys].dtypes in ["int16",
+                "uint32"]:
+                d_type = Integer
+            elif df[keys].dtypes in ["float32",
+                "float64"]:
+                d_type = Float(precision=25)
+            elif df[keys].dtypes == "cfloat":
+                d_type = Unicode(50)
+            elif df[keys].dtypes == "datetime64":
+                d_type = DateTime
+            elif df[keys].dtypes == "timedelta64":
+                d_type = Interval
+            #if isinstance(dataset[0], (int, long, float)):
+            #    d_type = Float(precision=20)
+            else:
+                d_type = Unicode(200)
 
+            d_fields[keys] = d_type
 
-                            else:
-                                declined_rtn.append(e_str)
+        values = {"alias": alias,
+            "full_name": alias,
+            "data_dimension": 1,
+            "author": author,
+            "data_fields": d_fields,
+            "script_path": script_path}
 
-                    except:
-                        # Necessary to keep the program going despite one bad set
-                        e = sys.exc_info()
-                        print ("Could not write \n{0}\nto Database. Error {1}"
-                                .format(record, e))
-                        continue
-                self.session.commit()
-                self.metadata.create_all(bind=self.engine, checkfirst=True)
-                return True
+        self.new_entry(Rtn, values)
+        self.refresh_schema()
+        return True
+
+    def _get_id(self, target, name, create=True):
+        """
+        Return the primary key of the compound, user or routine called name.
+
+        Keys are served from the id cache; only unknown names are looked up
+        in the database.
+
+        :param target: Cpd, Usr or Rtn
+        :param str name: Compound name, user name or routine alias
+        :param bool create: Create compounds and users that do not exist yet
+        :return: The primary key, or None if the record does not exist
+        :rtype: int
+        """
+
+        key = self.id_cache.get(target.__tablename__, name)
+        if key is not None:
+            return key
+        id_col = list(target.__table__.primary_key)[0]
+        name_col = target.__table__.c[target._name_field]
+        key = self.session.query(id_col).filter(name_col == name).scalar()
+        if key is None and create and target in (Cpd, Usr):
+            self.new_entry(target, {target._name_field: name})
+            key = self.session.query(id_col).filter(name_col == name).scalar()
+        if key is not None:
+            self.id_cache.set(target.__tablename__, name, key)
+        return key
+
+    def _select_cpd_ids(self, names):
+        """
+        Look up the keys of the compounds in names with IN-batched selects.
+
+        :param list names: Compound names
+        :return: {name: cpd_id} of the compounds that exist
+        :rtype: dict
+        """
+
+        cpd_tbl = Cpd.__table__
+        by_name = {}
+        for i in range(0, len(names), _IN_CHUNK):
+            stmt = (sa.select([cpd_tbl.c.name, cpd_tbl.c.cpd_id])
+                .where(cpd_tbl.c.name.in_(names[i:i + _IN_CHUNK])))
+            by_name.update(self.conn.execute(stmt).fetchall())
+        found = {}
+        for name in names:
+            # Names are stored as text, numeric sample names come back as str
+            key = by_name.get(name, by_name.get(str(name)))
+            if key is not None:
+                found[name] = key
+        return found
+
+    def _get_cpd_ids(self, samples):
+        """
+        Return the keys of all compounds in samples, creating the missing ones.
+
+        Known compounds are resolved from the id cache or with one set-based
+        lookup, the missing ones are inserted with a single executemany
+        statement.
+
+        :param samples: Iterable of compound names
+        :return: {name: cpd_id} for every name in samples
+        :rtype: dict
+        """
+
+        cpd_ids = {}
+        missing = []
+        for name in set(samples):
+            if pandas.isnull(name):
+                continue
+            key = self.id_cache.get(Cpd.__tablename__, name)
+            if key is None:
+                missing.append(name)
+            else:
+                cpd_ids[name] = key
+        if missing:
+            found = self._select_cpd_ids(missing)
+            cpd_ids.update(found)
+            missing = [name for name in missing if name not in found]
+        if missing:
+            self.session.commit()
+            trans = self.conn.begin()
+            try:
+                self.conn.execute(Cpd.__table__.insert(),
+                    [{"name": name} for name in missing])
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            finally:
+                self.result_cache.bump(Cpd.__tablename__)
+            cpd_ids.update(self._select_cpd_ids(missing))
+        for name in cpd_ids:
+            self.id_cache.set(Cpd.__tablename__, name, cpd_ids[name])
+        return cpd_ids
+
+    def _fingerprint(self, path, routine):
+        """
+        Compare a raw data file with the fingerprints stored in `raw_data`.
+
+        Size and mtime are checked first; the file is only hashed if they
+        differ from the last ingested version.
+
+        :param str path: Path of the raw data file
+        :param str routine: Alias of the routine reading the file
+        :return: Fingerprint dict with the keys of Raw plus 'ingested', which
+                is True if this version of the file is already in the
+                database. None if the file cannot be read.
+        :rtype: dict
+        """
+
+        raw_tbl = Raw.__table__
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            print ("Could not fingerprint '{0}': {1}".format(path, e))
+            return None
+        raw = {"raw_id": None, "path": path, "routine": routine,
+            "size": stat.st_size, "mtime": stat.st_mtime, "sha1": None,
+            "ingested": False}
+        known = self.conn.execute(raw_tbl.select()
+            .where(raw_tbl.c.path == path)
+            .where(raw_tbl.c.routine == routine)
+            .order_by(raw_tbl.c.raw_id.desc())).first()
+        if known is not None and (known.size, known.mtime) == (
+                raw["size"], raw["mtime"]):
+            raw.update(raw_id=known.raw_id, sha1=known.sha1, ingested=True)
+            return raw
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as raw_file:
+            for block in iter(lambda: raw_file.read(1 << 20), b""):
+                sha1.update(block)
+        raw["sha1"] = sha1.hexdigest()
+        if known is not None and known.sha1 == raw["sha1"]:
+            # Touched, but not changed
+            self.conn.execute(raw_tbl.update()
+                .where(raw_tbl.c.raw_id == known.raw_id)
+                .values(size=raw["size"], mtime=raw["mtime"]))
+            raw.update(raw_id=known.raw_id, ingested=True)
+        return raw
+
+    def _register_raw(self, raw):
+        """
+        Store a new fingerprint and deactivate the results of earlier versions
+        of the same file. Must run inside the transaction of the results.
+
+        :param dict raw: Fingerprint from _fingerprint()
+        :return: The raw_id
+        :rtype: int
+        """
+
+        raw_tbl = Raw.__table__
+        res_tbl = Res.__table__
+        earlier = (sa.select([raw_tbl.c.raw_id])
+            .where(raw_tbl.c.path == raw["path"])
+            .where(raw_tbl.c.routine == raw["routine"]))
+        self.conn.execute(res_tbl.update()
+            .where(res_tbl.c.raw_data_id.in_(earlier))
+            .values(active=False))
+        return self.conn.execute(raw_tbl.insert(), {
+            key: raw[key] for key in ("path", "routine", "size", "mtime",
+            "sha1")}).inserted_primary_key[0]
+
+    def _bulk_insert(self, df, meta_values, chunk_size=1000, raw=None):
+        """
+        Write one data set in a single transaction.
+
+        The records are written in chunks, each under its own savepoint. A
+        chunk that fails is split in halves until the bad records are
+        isolated; these are moved to the quarantine table together with the
+        error message, while all other records are written.
+
+        :param pandas.DataFrame df: The data set, one row per well. Must have
+                a column 'Sample'.
+        :param dict meta_values: The meta values of the data set
+        :param int chunk_size: Number of records per statement batch
+        :param dict raw: Fingerprint of the raw data file from
+                _fingerprint(). It is stored with the first data set of the
+                file and its key is written to raw_data_id.
+        :return: Number of records written
+        :rtype: int
+        """
+
+        rtn_tbl = self.metadata.tables[meta_values['routine']]
+        if not len(df):
+            return 0
+        base = {
+            "user": self._get_id(Usr, meta_values['user']),
+            "routine": self._get_id(Rtn, meta_values['routine']),
+            "date": _parse_date(meta_values['date']),
+            "active": meta_values['active']}
+        cpd_ids = self._get_cpd_ids(set(df['Sample'].unique()))
+        self.session.commit()
+        # The driver needs Python objects, so tolist() converts every column
+        # in one step; the rows are positional tuples, see _insert_rows().
+        keys = [str(col) for col in df.columns]
+        columns = [df[col].tolist() for col in df.columns]
+        sample_ids = [cpd_ids.get(s) for s in df['Sample'].tolist()]
+        written = 0
+        rejected = []
+        new_raw = raw is not None and raw["raw_id"] is None
+        trans = self.conn.begin()
+        try:
+            if new_raw:
+                raw["raw_id"] = self._register_raw(raw)
+            if raw is not None:
+                base["raw_data_id"] = raw["raw_id"]
+            for i in range(0, len(df), chunk_size):
+                rows = list(zip(*[col[i:i + chunk_size] for col in columns]))
+                written += self._write_chunk(keys, rows,
+                    sample_ids[i:i + chunk_size], base, rtn_tbl, rejected)
+            if rejected:
+                self.conn.execute(Qtn.__table__.insert(), [{
+                    "routine": meta_values['routine'],
+                    "meta_values": meta_values,
+                    "record": dict(zip(keys, row)),
+                    "error": str(e)} for row, e in rejected])
+                print ("{0} records of data set\n{1}\nmoved to quarantine."
+                    .format(len(rejected), meta_values))
+            trans.commit()
+        except:
+            trans.rollback()
+            if new_raw:
+                raw["raw_id"] = None
+            raise
+        finally:
+            self.result_cache.bump(Res.__tablename__, meta_values['routine'])
+        return written
+
+    def _insert_results(self, base, sample_ids):
+        """
+        Insert one `results` row per sample and return their keys in order.
+
+        PostgreSQL returns the keys of a multi-row insert with RETURNING.
+        SQLite serializes writers, so once the insert holds the write lock the
+        new rowids are the consecutive ids up to MAX(res_id). Other dialects
+        read the keys back by routine and user and raise DbError if another
+        writer added rows in between, so the chunk is not mis-linked.
+
+        :param dict base: Common values of the `results` rows
+        :param list sample_ids: cpd_id of every row
+        :return: res_id of every row
+        :rtype: list
+        """
+
+        res_tbl = Res.__table__
+        params = [dict(base, sample=sample_id) for sample_id in sample_ids]
+        dialect = self.engine.dialect
+        if dialect.name == "postgresql":
+            return [row[0] for row in self.conn.execute(
+                res_tbl.insert().values(params).returning(res_tbl.c.res_id))]
+        if dialect.name == "sqlite":
+            self.conn.execute(res_tbl.insert(), params)
+            last_id = self.conn.execute(
+                sa.select([sa.func.max(res_tbl.c.res_id)])).scalar()
+            return list(range(last_id - len(params) + 1, last_id + 1))
+        last_id = self.conn.execute(
+            sa.select([sa.func.max(res_tbl.c.res_id)])).scalar() or 0
+        self.conn.execute(res_tbl.insert(), params)
+        res_ids = [row[0] for row in self.conn.execute(
+            sa.select([res_tbl.c.res_id])
+            .where(res_tbl.c.res_id > last_id)
+            .where(res_tbl.c.routine == base['routine'])
+            .where(res_tbl.c.user == base['user'])
+            .order_by(res_tbl.c.res_id))]
+        if len(res_ids) != len(params):
+            raise DbError("Expected {0} new results but found {1}; the "
+                "table was written concurrently.".format(
+                len(params), len(res_ids)))
+        return res_ids
+
+    def _insert_rows(self, tbl, keys, rows):
+        """
+        Insert value tuples in the order of keys with one executemany.
+
+        If the driver takes positional parameters (e.g. SQLite), the INSERT
+        is compiled once per table and column set, and the tuples go to the
+        DBAPI cursor as they are, without a parameter dict per row. Only the
+        columns whose type converts values for the driver (e.g. DateTime on
+        SQLite) are processed, column by column. Other drivers get dicts
+        through SQLAlchemy.
+
+        :param tbl: The table
+        :param list keys: Column names
+        :param list rows: Value tuples in the order of keys
+        """
+
+        dialect = self.engine.dialect
+        stmt_key = ("insert", tbl.name, tuple(keys))
+        prepared = self._statements.get(stmt_key)
+        if prepared is None:
+            compiled = tbl.insert().compile(dialect=dialect, column_keys=keys)
+            names = compiled.positiontup or []
+            prepared = False
+            if compiled.positional and sorted(names) == sorted(keys):
+                prepared = (str(compiled), [keys.index(name) for name in
+                    names], [tbl.c[name].type.dialect_impl(dialect)
+                    .bind_processor(dialect) for name in names])
+            self._statements[stmt_key] = prepared
+        if not prepared:
+            self.conn.execute(tbl.insert(),
+                [dict(zip(keys, row)) for row in rows])
+            return
+        sql, order, processors = prepared
+        if order != list(range(len(keys))):
+            rows = [tuple(row[i] for i in order) for row in rows]
+        if any(processors):
+            columns = [list(map(process, column)) if process else column
+                for process, column in zip(processors, zip(*rows))]
+            rows = list(zip(*columns))
+        cursor = self.conn.connection.cursor()
+        try:
+            cursor.executemany(sql, rows)
+        except dialect.dbapi.Error as e:
+            raise sa.exc.DBAPIError.instance(sql, rows, e, dialect.dbapi.Error)
+        finally:
+            cursor.close()
+
+    def _write_chunk(self, keys, rows, sample_ids, base, rtn_tbl, rejected):
+        """
+        Insert rows into `results` and the routine table under a savepoint.
+
+        The keys of the new `results` rows (see _insert_results) are used as
+        `link` of the routine table rows, which are inserted with a second
+        statement. If the chunk fails, it is rolled back and both halves are
+        retried. Single rows that fail are appended to rejected as
+        (row, exception).
+
+        :param list keys: Column names of the routine table
+        :param list rows: Value tuples in the order of keys
+        :param list sample_ids: cpd_id of every row
+        :return: Number of rows written
+        :rtype: int
+        """
+
+        savepoint = self.conn.begin_nested()
+        try:
+            res_ids = self._insert_results(base, sample_ids)
+            self._insert_rows(rtn_tbl, keys + ["link"],
+                [row + (res_id,) for row, res_id in zip(rows, res_ids)])
+            savepoint.commit()
+        except DbError:
+            savepoint.rollback()
+            raise
+        except (sa.exc.SQLAlchemyError, TypeError, ValueError) as e:
+            savepoint.rollback()
+            if len(rows) == 1:
+                rejected.append((rows[0], e))
+                return 0
+            half = len(rows) // 2
+            return (
+                self._write_chunk(keys, rows[:half], sample_ids[:half], base,
+                    rtn_tbl, rejected) +
+                self._write_chunk(keys, rows[half:], sample_ids[half:], base,
+                    rtn_tbl, rejected))
+        return len(rows)
+
+    def reingest_quarantine(self, routine=None, chunk_size=1000):
+        """
+        Write the records from the quarantine table to the database again,
+        e.g. after the routine table was fixed.
+
+        Records that still cannot be written are quarantined anew.
 
+        :param str routine: Only re-ingest records of this routine
+        :param int chunk_size: Number of records per statement batch
+        :return: Number of records written
+        :rtype: int
+
+        >>> DbConnection.reingest_quarantine('growth')
+        """
+
+        self.refresh_schema()
+        q_tbl = Qtn.__table__
+        stmt = q_tbl.select().order_by(q_tbl.c.q_id)
+        if routine:
+            stmt = stmt.where(q_tbl.c.routine == routine)
+        datasets = collections.OrderedDict()
+        for row in self.conn.execute(stmt).fetchall():
+            key = repr(sorted(row.meta_values.items()))
+            dataset = datasets.setdefault(key, [row.meta_values, [], []])
+            dataset[1].append(row.q_id)
+            dataset[2].append(row.record)
+        written = 0
+        for meta_values, q_ids, records in datasets.values():
+            written += self._bulk_insert(pandas.DataFrame(records),
+                meta_values, chunk_size=chunk_size)
+            for i in range(0, len(q_ids), _IN_CHUNK):
+                self.conn.execute(q_tbl.delete()
+                    .where(q_tbl.c.q_id.in_(q_ids[i:i + _IN_CHUNK])))
+        return written
 
     def load_results(self, filter_str,
-            sl=True, sp=False, dl=False, dp=False):
+            sl=True, sp=False, dl=False, dp=False, columns=None, since=None,
+            until=None, compact=False, workers=4):
         """
         Retrieve data from the database.
 
         Return the filtered data as a pandas data frame. Has to be called for
         every routine, since data sets from different routines might be in-
-        compatible.
-        :param str filter_str: The filter string (SQLAlchemy syntax)
+        compatible. Results are only cached if result_cache is given a
+        max_bytes, see ResultCache.
+        :param str filter_str: The filter string, see parse_filter()
         :param bool sl: Save the result as a list
         :param bool sp: Save the result as a plot
         :param bool dl: Display the result as a list
         :param bool dp: Display the result as a plot
+        :param dict columns: Columns to read per routine,
+                {routine: [column names]}. 'link' is always included, routines
+                not in the dict are read completely.
+        :param since: Only results dated since (inclusive), datetime or
+                date string
+        :param until: Only results dated before until (exclusive)
+        :param bool compact: Return memory-saving typed frames, see
+                compact_frame()
+        :param int workers: Maximum number of routine tables read at the
+                same time, each over its own connection. In-memory SQLite
+                databases are always read sequentially.
         :return: Tuple of Dataframe with the retrieved results, dict
         :rtype: Tuple
 
-        .. seealso:: To learn about SQLAlchemy syntax, refer to their documentation.
+        >>> DbConnection.load_results("Rtn.alias == 'ic50' AND "
+        ...     "Cpd.name IN ('cpd1', 'cpd2')", columns={'ic50': ['IC50']})
         """
 
-        data_pool = {}
+        filter_str = _date_range(filter_str, since, until)
+        key = (_normalize_filter(filter_str),
+            tuple(sorted((k, tuple(v)) for k, v in (columns or {}).items())),
+            compact)
+        caching = self.result_cache.max_bytes > 0
+        if caching:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                # Copies, so that callers can not modify the cached frames
+                return (dict((k, v.copy()) for k, v in cached[0].items()),
+                    dict(cached[1]))
         df_pool = {}
-        dir_pool = {}
-        filter_object = eval(filter_str)
+        versions = self.result_cache.versions(["results", "compounds",
+            "users", "routines"])
+        queries, dir_pool = self._result_queries(filter_str, columns)
+        versions.update(self.result_cache.versions(
+            routine for routine, _ in queries))
+        stmts = [c for _, c in queries]
+        if workers > 1 and len(stmts) > 1 and self.database != ":memory:":
+            # The routine tables are independent, so they are read in
+            # parallel; the latency is that of the slowest table.
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(workers, len(stmts))) as pool:
+                fetched = list(pool.map(self._fetch, stmts))
+        else:
+            fetched = [self._fetch(c, self.conn) for c in stmts]
+        for (routine, _), (keys, d) in zip(queries, fetched):
+            if not d:
+                continue
+            result_df = pandas.DataFrame(data=d, columns=keys)
+            del d
+            if compact:
+                compact_frame(result_df)
+            df_pool.setdefault(routine, result_df)
+        if not caching:
+            return df_pool, dir_pool
+        # The frames are kept as read, the caller gets the only copy
+        self.result_cache.set(key, (df_pool, dir_pool), versions,
+            sum(int(df.memory_usage(deep=True).sum())
+            for df in df_pool.values()))
+        return (dict((k, v.copy()) for k, v in df_pool.items()),
+            dict(dir_pool))
+
+    def iter_results(self, filter_str, chunk_size=10000, columns=None,
+            since=None, until=None, compact=False):
+        """
+        Retrieve data from the database in chunks.
+
+        Like load_results(), but yields the rows of every routine as data
+        frames of at most chunk_size rows, so that large result sets never
+        have to be held in memory at once. Dialects that support server-side
+        cursors (e.g. PostgreSQL, MySQL) stream the rows from the server.
+        :param str filter_str: The filter string, see parse_filter()
+        :param int chunk_size: Maximum number of rows per data frame
+        :param dict columns: Columns to read per routine, see load_results()
+        :param since, until: Date range, see load_results()
+        :param bool compact: Return typed frames, see compact_frame(). The
+                categories may differ from chunk to chunk.
+        :return: Generator of (routine, DataFrame, working directory) tuples
+        :rtype: generator
+
+        >>> for routine, df, user_dir in DbConnection.iter_results(<filter>):
+        ...     df.to_csv(out, header=False)
+        """
+
+        filter_str = _date_range(filter_str, since, until)
+        queries, dir_pool = self._result_queries(filter_str, columns)
+        conn = self.conn.execution_options(stream_results=True,
+            compiled_cache=self._compiled)
+        for routine, c in queries:
+            result = conn.execute(c)
+            try:
+                cols = result.keys()
+                while True:
+                    d = result.fetchmany(chunk_size)
+                    if not d:
+                        break
+                    df = pandas.DataFrame(data=d, columns=cols)
+                    if compact:
+                        compact_frame(df)
+                    yield routine, df, dir_pool.get(routine)
+            finally:
+                result.close()
+
+    def export_results(self, filter_str, directory, compression="zstd",
+            chunk_size=100000, **kwargs):
+        """
+        Save query results in a columnar binary format.
+
+        Every routine is written to <directory>/<routine>.arrow, an Arrow
+        IPC (Feather v2) file that stores the schema with the data. The rows
+        are streamed from the database chunk by chunk. Read the files with
+        read_export().
+
+        :param str filter_str: The filter string, see parse_filter()
+        :param str directory: Target directory, created if necessary
+        :param str compression: 'zstd', 'lz4' or None. Uncompressed files are
+                bigger, but can be read without copying.
+        :param int chunk_size: Rows per chunk
+        :param kwargs: columns, since and until as in load_results()
+        :return: {routine: path of the file}
+        :rtype: dict
+
+        >>> paths = DbConnection.export_results("Rtn.alias == 'ic50'", 'out/')
+        >>> df = read_export(paths['ic50'])
+        """
+
+        pa = _arrow()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = {}
+        writer = None
         try:
-            if isinstance(filter_object, tuple):
-                a = self.session.query(Res.res_id, Rtn.alias).join(Cpd, Usr)\
-                    .filter(*filter_object).all()
-            else:
-                a = self.session.query(Res.res_id, Rtn.alias).join(Cpd, Usr)\
-                    .filter(filter_object).all()
-        except SyntaxError:
-            raise DbError("Could not create filter\n{0}\n".format(filter_str) +
-                "Please try again.")
-            return
-        if a:
-            for result in a:
-                routine = result[1]
-                tbl = Table(routine, self.metadata, autoload=True,
-                    autoload_with=self.engine)
-                c = tbl.select().where(tbl.c.link == result[0])
-                d = self.conn.execute(c).fetchone()
-                if d is not None:
-                    data_pool.setdefault(routine, []).append(d)
-            for keys in data_pool:
-                cols = [str(col).replace("{0}.".format(keys), "") for col in
-                    self.metadata.tables[keys].columns]
-                result_df = pandas.DataFrame(data=data_pool[keys], columns=cols)
-                df_pool.setdefault(keys, result_df)
+            for routine, df, _ in self.iter_results(filter_str, chunk_size,
+                    **kwargs):
+                if routine not in paths:
+                    if writer is not None:
+                        writer.close()
+                    table = pa.Table.from_pandas(df, preserve_index=False)
+                    # The first chunk may have columns without any values
+                    table = table.cast(_arrow_schema(pa, table,
+                        self.metadata.tables[routine].c))
+                    schema = table.schema.with_metadata(dict(
+                        table.schema.metadata or {}, screening_mgmt=json.dumps({
+                        "routine": routine, "filter": filter_str,
+                        "exported": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        "version": __version__})))
+                    paths[routine] = os.path.join(directory, routine + ".arrow")
+                    writer = pa.ipc.new_file(paths[routine], schema,
+                        options=pa.ipc.IpcWriteOptions(
+                        compression=compression))
+                else:
+                    table = pa.Table.from_pandas(df, schema=schema,
+                        preserve_index=False)
+                writer.write_table(table.replace_schema_metadata(
+                    schema.metadata))
+        finally:
+            if writer is not None:
+                writer.close()
+        return paths
+
+    def _fetch(self, stmt, conn=None):
+        """
+        Execute stmt and return its column names and rows.
+
+        :param conn: Connection to use, by default a new connection from the
+                pool, which makes it safe to call from other threads.
+        :rtype: tuple
+        """
+
+        if conn is None:
+            with self.engine.connect() as conn:
+                return self._fetch(stmt, conn)
+        result = conn.execution_options(
+            compiled_cache=self._compiled).execute(stmt)
+        return result.keys(), result.fetchall()
+
+    def _result_queries(self, filter_str, columns=None):
+        """
+        Build the select statements for load_results() and iter_results().
+
+        :param str filter_str: The filter string, see parse_filter()
+        :param dict columns: {routine: [column names]} to read
+        :return: List of (routine, select) tuples, one per matching
+                routine, and dict of the working directory of every routine
+        :rtype: tuple
+        """
+
+        queries = []
+        dir_pool = {}
+        key, criterion = self._parsed_filter(filter_str)
+        conn = self.conn.execution_options(compiled_cache=self._compiled)
+        joined = Res.__table__.join(Cpd.__table__).join(Usr.__table__)\
+            .join(Rtn.__table__, Res.routine == Rtn.rtn_id)
+        alias_key = (key, "aliases")
+        if alias_key not in self._statements:
+            self._statements[alias_key] = sa.select([Rtn.alias])\
+                .select_from(joined).where(criterion).distinct()
+        aliases = [alias for alias, in
+            conn.execute(self._statements[alias_key])]
+        if aliases:
+            self.refresh_schema()
+            for routine in aliases:
+                stmt_key = (key, routine, tuple((columns or {}).get(routine,
+                    ())))
+                c = self._statements.get(stmt_key)
+                if c is None:
+                    c = self._statements[stmt_key] = self._routine_select(
+                        routine, joined, criterion, (columns or {}).get(routine))
+                queries.append((routine, c))
             dir_col = self.session.query(Rtn.alias, Usr.working_directory)\
-                .filter(Rtn.alias.in_(set(zip(*a)[1])) ).all()
+                .join(Usr, Rtn.author == Usr.usr_name)\
+                .filter(Rtn.alias.in_(aliases)).all()
             dir_pool = dict(elem for elem in dir_col)
-            return df_pool, dir_pool
+            return queries, dir_pool
         else:
             raise DbError("This search does not match any records.")
 
+    def aggregate_results(self, filter_str, routine, values=None,
+            by=("compound",), since=None, until=None):
+        """
+        Compute per-group summary statistics in the database.
+
+        Instead of loading every well, the rows of the routine table that
+        match the filter are grouped in SQL and only mean, standard deviation
+        and count of every readout are returned.
+        :param str filter_str: The filter string, see parse_filter()
+        :param str routine: Alias of the routine
+        :param list values: Numeric columns of the routine table to
+                summarize, default all numeric columns except id and link
+        :param tuple by: Grouping keys: 'compound', 'user', 'date' or the
+                name of a column of the routine table, e.g. 'plate'
+        :param since, until: Date range, see load_results()
+        :return: One row per group with the columns of by and
+                <value>_mean, <value>_sd and <value>_n for every value
+        :rtype: pandas.DataFrame
+
+        >>> DbConnection.aggregate_results("Usr.usr_name == 'ah'", 'ic50',
+        ...     ['IC50'], by=('compound', 'date'))
+        """
+
+        _, criterion = self._parsed_filter(_date_range(filter_str, since,
+            until))
+        self.refresh_schema()
+        if routine not in self.metadata.tables:
+            raise DbError("Routine '{0}' does not exist.".format(routine))
+        tbl = self.metadata.tables[routine]
+        if values is None:
+            values = [col.name for col in tbl.columns if col.name not in
+                ("id", "link") and isinstance(col.type, (Integer, Float,
+                sa.Numeric))]
+        keys = {"compound": Cpd.name, "user": Usr.usr_name, "date": Res.date}
+        try:
+            groups = [(keys[name] if name in keys else tbl.c[name])
+                .label(name) for name in by]
+            cols = [tbl.c[name] for name in values]
+        except KeyError as e:
+            raise DbError("Routine '{0}' has no column {1}".format(routine, e))
+        joined = tbl.join(Res.__table__, tbl.c.link == Res.res_id)\
+            .join(Cpd.__table__, Res.sample == Cpd.cpd_id)\
+            .join(Usr.__table__, Res.user == Usr.usr_id)\
+            .join(Rtn.__table__, Res.routine == Rtn.rtn_id)
+        where = sa.and_(criterion, Rtn.alias == routine)
+        stddev = _STDDEV_FUNCTIONS.get(self.engine.dialect.name)
+        fields = list(groups)
+        if stddev:
+            for col in cols:
+                fields += [
+                    sa.func.avg(col).label(col.name + "_mean"),
+                    sa.func.count(col).label(col.name + "_n"),
+                    getattr(sa.func, stddev)(col).label(col.name + "_sd")]
+            stmt = sa.select(fields).select_from(joined).where(where)\
+                .group_by(*groups).order_by(*groups)
+        else:
+            # Without a standard deviation function (e.g. SQLite), the
+            # squared deviations are summed around the group means of a
+            # first pass; sum and sum of squares would cancel out.
+            means = sa.select(groups + [sa.func.avg(col).label(col.name)
+                for col in cols]).select_from(joined).where(where)\
+                .group_by(*groups).alias("means")
+            joined = joined.join(means, sa.and_(*[group.element ==
+                means.c[group.name] for group in groups]))
+            for col in cols:
+                mean = means.c[col.name]
+                fields += [
+                    mean.label(col.name + "_mean"),
+                    sa.func.count(col).label(col.name + "_n"),
+                    sa.func.sum((col - mean) * (col - mean))
+                    .label(col.name + "_ss")]
+            stmt = sa.select(fields).select_from(joined).where(where)\
+                .group_by(*(groups + [means.c[col.name] for col in cols]))\
+                .order_by(*groups)
+        result = self.conn.execution_options(
+            compiled_cache=self._compiled).execute(stmt)
+        df = pandas.DataFrame(data=result.fetchall(), columns=result.keys())
+        if not stddev:
+            for col in cols:
+                n = df[col.name + "_n"]
+                ss = df.pop(col.name + "_ss").astype(float)
+                df[col.name + "_sd"] = (ss / (n - 1)).where(n > 1) ** 0.5
+        return df[list(by) + [col.name + suffix for col in cols for suffix
+            in ("_mean", "_sd", "_n")]]
+
+    def _parsed_filter(self, filter_str):
+        """
+        Parse filter_str, reusing earlier results.
+
+        :return: The normalized filter string and the filter expression
+        :rtype: tuple
+        """
+
+        key = _normalize_filter(filter_str)
+        criterion = self._statements.get(key)
+        if criterion is None:
+            criterion = self._statements[key] = parse_filter(filter_str)
+        return key, criterion
+
+    def _routine_select(self, routine, joined, criterion, columns=None):
+        """
+        Build the select of the rows of one routine table that belong to
+        the results matching criterion.
+
+        :param str routine: Alias of the routine
+        :param joined: Join of results, compounds, users and routines
+        :param criterion: The parsed filter
+        :param list columns: Columns to read besides link, default all
+        :return: The select statement
+        """
+
+        tbl = Table(routine, self.metadata, autoload=True,
+            autoload_with=self.engine)
+        # One query per routine: the routine rows of all matching results,
+        # instead of one select per result.
+        res_ids = sa.select([Res.res_id]).select_from(joined).where(
+            sa.and_(criterion, Rtn.alias == routine))
+        if columns:
+            try:
+                fields = [tbl.c.link] + [tbl.c[name] for name in columns
+                    if name != "link"]
+            except KeyError as e:
+                raise DbError("Routine '{0}' has no column {1}"
+                    .format(routine, e))
+            c = sa.select(fields)
+        else:
+            c = tbl.select()
+        return c.where(tbl.c.link.in_(res_ids)).order_by(tbl.c.link)
+
     def get_summary(self, routine, user_dir, df, plot=0, list_=1,
             *args, **kwargs):
         """
@@ -547,23 +2297,16 @@ class DbConnection(object):
         >>> img.show()
         """
 
-        sys.path.append(user_dir)
         summary = {}
         try:
-            exec("import {0} as rtn".format(routine)) in locals()
+            rtn = self.routines.get(routine, user_dir)
         except ImportError:
             errortext = ("""Module '{0}' not found in '{1}'.\n
                 \nDo you want to look for it yourself?"""
                 .format(routine, user_dir))
             if tkMessageBox.askyesno("Module not found", errortext):
                 loc = tkfd.askopenfilename(title="Select the script")
-                try:
-                    path, file_ = loc.rsplit(os.sep, 1)
-                except ValueError:
-                    path, file_ = loc.rsplit("/", 1)
-                sys.path.append(path)
-                exec("import {0} as rtn".format(file_.rsplit(".",
-                        1)[0])) in locals()
+                rtn = self.routines.load(loc)
             else:
                 return
         except SyntaxError:
@@ -573,13 +2316,7 @@ class DbConnection(object):
             if tkMessageBox.askyesno("Choose module", errortext):
                 loc = tkfd.askopenfilename(title="Select the script")
                 try:
-                    path, file_ = loc.rsplit(os.sep, 1)
-                except ValueError:
-                    path, file_ = loc.rsplit("/", 1)
-                sys.path.append(path)
-                try:
-                    exec("import {0} as rtn".format(file_.rsplit(".",
-                        1)[0])) in locals()
+                    rtn = self.routines.load(loc)
                 except:
                     raise DbError("Impossible to open script")
             else:
@@ -596,6 +2333,58 @@ class DbConnection(object):
                 summary["plot"] = None
         return summary
 
+    def render_plots(self, results, user_dirs, directory=None, workers=None,
+            *args, **kwargs):
+        """
+        Save the summarize_plot() figures of several routines as images.
+
+        The figures are drawn in a pool of worker processes with the
+        non-interactive Agg backend, so only the file names come back.
+        :param dict results: {routine: DataFrame}, e.g. from load_results()
+        :param dict user_dirs: {routine: directory of the routine script}
+        :param str directory: Where to save the images, created if
+                necessary. By default the directory of the routine script.
+        :param int workers: Number of worker processes, default the number
+                of CPUs
+        :param args, kwargs: Passed to summarize_plot()
+        :return: {routine: path of the image}. Routines without
+                summarize_plot() or whose plot failed are left out.
+        :rtype: dict
+
+        >>> results, dirs = DbConnection.load_results(<filter>)
+        >>> paths = DbConnection.render_plots(results, dirs)
+        """
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        jobs = {}
+        for routine, df in results.items():
+            try:
+                rtn = self.routines.get(routine, user_dirs.get(routine))
+            except (ImportError, SyntaxError) as e:
+                print ("Could not load routine '{0}':\n{1}".format(routine, e))
+                continue
+            if not hasattr(rtn, "summarize_plot"):
+                continue
+            path = os.path.join(directory or user_dirs[routine],
+                "graphs_{0}_{1}.png".format(routine, time.strftime("%d_%m_%Y")))
+            jobs[routine] = (rtn.__file__, df, path)
+        paths = {}
+        if not jobs:
+            return paths
+        with concurrent.futures.ProcessPoolExecutor(
+                min(workers or os.cpu_count() or 1, len(jobs))) as pool:
+            futures = dict((pool.submit(_render_plot, script, df, path, args,
+                kwargs), routine) for routine, (script, df, path) in
+                jobs.items())
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    paths[futures[future]] = future.result()
+                except Exception as e:
+                    print ("Could not plot '{0}':\n{1}".format(
+                        futures[future], e))
+        return paths
+
     def update(self, table, id_field, id_value, val):
         """
         Update a field in the database.
@@ -615,12 +2404,15 @@ class DbConnection(object):
             where(table.c[id_field] == id_value).
             values(**val))
         self.engine.execute(stmt)
+        self.id_cache.invalidate(table.name)
+        self.result_cache.bump(table.name)
 
 
 class Cpd(Base):
     """Class for the compound table"""
 
     __tablename__ = "compounds"
+    _name_field = "name"
     cpd_id = Column(Integer, primary_key=True)
     name = Column(String(200), unique=True, nullable=False)
     group = Column(String(200))
@@ -640,6 +2432,7 @@ class Usr(Base):
     """Class for the user table."""
 
     __tablename__ = "users"
+    _name_field = "usr_name"
     usr_id = Column(Integer, primary_key=True)
     usr_name = Column(String(20), unique=True, nullable=False)
     first_name = Column(String(50))
@@ -675,6 +2468,7 @@ class Rtn(Base):
     """Class for the routine table"""
 
     __tablename__ = "routines"
+    _name_field = "alias"
     rtn_id = Column(Integer, primary_key=True)
     alias = Column(String(20), unique=True, nullable=False)
     author = Column(String(20), ForeignKey('users.usr_name'))
@@ -700,12 +2494,10 @@ class Rtn(Base):
             else:
                 script_path = kwargs[key]
         if self.author:
-            if not conn.session.query(Usr.usr_name)\
-                    .filter(Usr.usr_name == self.author).first():
-                conn.new_entry(Usr, {"usr_name": self.author})
+            conn._get_id(Usr, self.author)
         cols = [
             Column('id', Integer, primary_key=True),
-            Column('link', Integer, ForeignKey('results.res_id'))]
+            Column('link', Integer, ForeignKey('results.res_id'), index=True)]
         for keys in self.data_fields:
             cols.append(Column(keys, self.data_fields[keys]))
         cls = Table(self.alias, conn.metadata,
@@ -714,6 +2506,7 @@ class Rtn(Base):
                 '__init__': _construct})
         mapper(dyn_class, cls)
         conn.metadata.create_all(bind=conn.engine)
+        conn.schema_changed()
         self.usr_dir = (
             conn.session.query(Usr.working_directory)
             .filter(Usr.usr_name==self.author).one())
@@ -738,53 +2531,55 @@ class Res(Base):
 
     __tablename__ = "results"
     res_id = Column(Integer, primary_key=True)
-    sample = Column(Integer, ForeignKey('compounds.cpd_id'))
-    user = Column(Integer, ForeignKey('users.usr_id'))
-    date = Column(DateTime)
-    routine = Column(Integer, ForeignKey('routines.rtn_id'))
+    sample = Column(Integer, ForeignKey('compounds.cpd_id'), index=True)
+    user = Column(Integer, ForeignKey('users.usr_id'), index=True)
+    date = Column(DateTime, index=True)
+    routine = Column(Integer, ForeignKey('routines.rtn_id'), index=True)
     active = Column(Boolean)
     raw_data_id = Column(Integer, unique=False)
 
     def __init__(self, conn, meta_data):
         """Constructor"""
 
-        date = meta_data['date']
-        if type(date) == int or float:
-            xld = xlrd.xldate_as_tuple(date, 1)
-            date = "{2}.{1}.{0}".format(*xld)
-            self.date = parser.parse(date, dayfirst=True, fuzzy=True)
-        else:
-            try:
-                self.date = parser.parse(date)
-            except ValueError:
-                self.date = 0
+        self.date = _parse_date(meta_data['date'])
         self.active = meta_data['active']
-        if (
-                conn.session.query(Cpd.cpd_id)
-                .filter(Cpd.name == meta_data['sample'])
-                .count() == 0):
-            conn.new_entry(Cpd, {"name": meta_data['sample']})
-        self.sample = (
-                conn.session.query(Cpd.cpd_id)
-                .filter(Cpd.name == meta_data['sample']).scalar())
-        if (
-                conn.session.query(Usr.usr_id)
-                .filter(Usr.usr_name == meta_data['user'])
-                .count() == 0):
-            conn.new_entry(Usr, {"usr_name": meta_data['user']})
-        self.user = (
-                conn.session.query(Usr.usr_id)
-                .filter(Usr.usr_name == meta_data['user']).scalar())
-        if (
-                conn.session.query(Rtn.rtn_id)
-                .filter(Rtn.alias == meta_data['routine'])
-                .count() == 0):
+        self.sample = conn._get_id(Cpd, meta_data['sample'])
+        self.user = conn._get_id(Usr, meta_data['user'])
+        routine = conn._get_id(Rtn, meta_data['routine'])
+        if routine is None:
             print ("Routine does not exist" )
             return
-        self.routine = (
-                conn.session.query(Rtn.rtn_id)
-                .filter(Rtn.alias==meta_data['routine'])
-                .scalar())
+        self.routine = routine
+
+
+class Qtn(Base):
+    """Class for the quarantine table, which keeps records that could not be
+    written, together with the error."""
+
+    __tablename__ = "quarantine"
+    q_id = Column(Integer, primary_key=True)
+    routine = Column(String(20))
+    meta_values = Column(PickleType)
+    record = Column(PickleType)
+    error = Column(Text)
+    date = Column(DateTime, default=sa.func.now())
+
+
+class Raw(Base):
+    """Class for the raw data table, which keeps the fingerprints of
+    ingested raw data files."""
+
+    __tablename__ = "raw_data"
+    # Every ingested file is looked up by path and routine
+    __table_args__ = (sa.Index("ix_raw_data_path", "path", "routine"),)
+    raw_id = Column(Integer, primary_key=True)
+    # Long enough for network shares, short enough to be indexed by MySQL
+    path = Column(String(512))
+    routine = Column(String(20))
+    size = Column(sa.BigInteger)
+    mtime = Column(Float(precision=25))
+    sha1 = Column(String(40))
+    date = Column(DateTime, default=sa.func.now())
 
 
 class CmdLine(cmd.Cmd):
@@ -853,13 +2648,15 @@ class CmdLine(cmd.Cmd):
         confirmation = raw_input("This will delete all tables. "+
             "Are you sure? [Y/N]")
         if confirmation.lower() in ['y','yes']:
-            self.connection.metadata.reflect(self.connection.engine)
+            self.connection.refresh_schema(force=True)
             for table in reversed(self.connection.metadata.sorted_tables):
                 try:
                     table.drop()
                 except(sa.exc.UnboundExecutionError, e ):
                     print (e)
                     print ( "Could not reset database. Try again" )
+            self.connection.id_cache.invalidate()
+            self.connection.schema_changed()
             self.connection._initialize()
             print("Database reset.")
 
@@ -872,6 +2669,9 @@ class CmdLine(cmd.Cmd):
             result = self.connection.conn.execute(line)
         except ( sa.exc.ProgrammingError, e ):
             result = str(e)
+        # Raw SQL may rename or delete any record
+        self.connection.result_cache.clear()
+        self.connection.id_cache.invalidate()
 
         print ("OUT: >> {0}".format(result) )
 
@@ -880,7 +2680,7 @@ class CmdLine(cmd.Cmd):
         of the table specified in line.
         """
 
-        self.connection.metadata.reflect(self.connection.engine)
+        self.connection.refresh_schema(force=True)
         print ("\nTables in database:\n" )
         print  (", ".join(self.connection.metadata.tables.keys()) )
         if line:
@@ -890,6 +2690,15 @@ class CmdLine(cmd.Cmd):
             except:
                 print ("Table '{0}' not found.".format(line) )
 
+    def do_index(self, line):
+        """Add missing indexes to the database."""
+
+        created = self.connection.ensure_indexes()
+        if created:
+            print ("Created indexes: {0}".format(", ".join(created)))
+        else:
+            print ("All indexes exist.")
+
     def do_load(self, line):
         """Load the first ten sets of the routine specified in line"""
 
@@ -926,6 +2735,8 @@ class CmdLine(cmd.Cmd):
             self.connection.engine.execute(line)
         except (sa.exc.ProgrammingError, e ):
             print ("Synatx error. \n {0}".format(e) )
+        self.connection.schema_changed()
+        self.connection.id_cache.invalidate()
 
     def do_ud(self, line):
         """reloads modules"""
@@ -1175,6 +2986,9 @@ class MainMenu():
 
         self.parent = parent
         self.conn = conn
+        if not conn.result_cache.max_bytes:
+            # Queries are often repeated while browsing
+            conn.result_cache.max_bytes = GUI_RESULT_CACHE_BYTES
         self.filter_elements=[]
         self.var_collection={}
 
@@ -1192,11 +3006,16 @@ class MainMenu():
             ("User: Last name", "Usr.last_name"),
             ("User: Affiliation", "Usr.affiliation"),
             ("Routine", "Rtn.alias"),
-            ("Author", "Rtn.author"))
+            ("Author", "Rtn.author"),
+            ("Date", "Res.date"))
         self.filter_fields = collections.OrderedDict(filter_fields)
+        # Days before today, or "run" for the date of the latest results
+        self.periods = collections.OrderedDict((("All dates", None),
+            ("Last run", "run"), ("Last week", 7), ("Last month", 30),
+            ("Last year", 365)))
 
         self.comp = ("==", "!=", "<=", ">=", "IN", "NOT IN", "LIKE")
-        conn.metadata.reflect(conn.engine)
+        conn.refresh_schema()
 
         nb = ttk.Notebook(self.parent, height=500, padding=5, width=550)
         self.q_frame = tk.Frame(nb, padx=5, pady=5)
@@ -1252,6 +3071,18 @@ class MainMenu():
             text="Save graphs").grid(row=2, column=2)
         tk.Checkbutton(self.q_frame, variable=self.c4,
             text="Save table").grid(row=2, column=3)
+        self.cols = tk.StringVar()
+        tk.Label(self.q_frame, text="Columns (routine: col1, col2; ...)",
+            justify="left").grid(row=6, column=4, sticky="w")
+        tk.Entry(self.q_frame, textvariable=self.cols,
+            width=12).grid(row=7, column=4, sticky="we")
+        self.period = tk.StringVar()
+        self.period.set("All dates")
+        tk.OptionMenu(self.q_frame, self.period,
+            *self.periods.keys()).grid(row=8, column=4, sticky="we")
+        tk.Button(self.q_frame, text="Export...",
+            command=lambda: self._export_results(),
+            width=12).grid(row=9, column=4, sticky="we")
 
         self.obj_collection={}
 
@@ -1389,8 +3220,8 @@ class MainMenu():
         def on_click():
             val = self.var_collection[line_number][0].get()
             if not val == "Choose criteria":
-                unique_values = [re.sub(r'[^\x00-\x7f]',r'_',value[0]) for value in\
-                    self.conn.session.query(eval(self.filter_fields[val]))\
+                unique_values = [re.sub(r'[^\x00-\x7f]',r'_',u"{0}".format(value[0])) for value in\
+                    self.conn.session.query(filter_field(self.filter_fields[val]))\
                     .distinct() if value[0]]
                 self.obj_collection[line_number].configure(values=unique_values)
 
@@ -1446,14 +3277,37 @@ class MainMenu():
             start = 1
         if self.to.get():
             kw["load_range"] = range(start, int(self.to.get()))
-        if self.conn.write_results(
-            self.current_rtn,
-            self.user_dir,
-            preview = preview,
-            **kw):
-
+        # Background jobs cannot ask whether to create an unknown routine,
+        # so custom scripts and routines without a table are imported here.
+        self.conn.refresh_schema(force=True)
+        known = self.current_rtn in self.conn.metadata.tables
+        if preview or not known or self.conn.database == ":memory:":
+            if self.conn.write_results(
+                self.current_rtn,
+                self.user_dir,
+                preview = preview,
+                **kw):
+
+                tkMessageBox.showinfo("Import finished",
+                        "Results loaded")
+            return
+        # Without preview, import in the background and keep the GUI usable
+        job = self.conn.submit_results(self.current_rtn, self.user_dir, **kw)
+        if job is not None:
+            self._watch_job(job)
+
+    def _watch_job(self, job):
+        """Poll a background import and report when it is done."""
+
+        if not job.done:
+            self.parent.after(500, self._watch_job, job)
+        elif job.errors:
+            tkMessageBox.showerror("Import finished with errors",
+                "{0} results loaded.\n\n{1}".format(job.rows,
+                "\n".join(job.errors[:10])))
+        else:
             tkMessageBox.showinfo("Import finished",
-                    "Results loaded")
+                    "{0} results loaded".format(job.rows))
 
     def _show_help(self):
         """Show the documentation"""
@@ -1484,12 +3338,14 @@ class MainMenu():
         if not query_line:
             query_line = self._build_query(**kwargs)
         try:
-            results, user_dir = self.conn.load_results(query_line)
+            results, user_dir = self.conn.load_results(query_line,
+                columns=_parse_columns(self.cols.get()),
+                since=self._period_start())
         except ( DbError, e ):
             tkMessageBox.showerror("Database error", e)
             return
 
-        if self.c1.get() or self.c3.get():
+        if self.c1.get():
             pl_val = 1
         else:
             pl_val = 0
@@ -1506,16 +3362,16 @@ class MainMenu():
                 # Show graphs
                 summary['plot'].show()
 
-            if self.c3.get():
-                # save graphs
-                filename = "{0}graphs_{1}_{2}.png".format(user_dir[keys],
-                    keys, time.strftime("%d_%m_%Y"))
-                summary['plot'].savefig(filename, bbox_inches='tight')
-
             if li_val:
                 text += summary['list']
                 text += "\n\n\n"
 
+        if self.c3.get():
+            # Save graphs, drawn in parallel in worker processes
+            paths = self.conn.render_plots(results, user_dir, **kwargs)
+            tkMessageBox.showinfo("Graphs saved",
+                "\n".join(sorted(paths.values())) or "No graphs to save.")
+
         if self.c2.get:
             self.newWindow = tk.Toplevel(self.parent)
             self.app = ListMenu(self.newWindow, text)
@@ -1527,56 +3383,62 @@ class MainMenu():
             f.write(text.encode('utf-8'))
             f.close()
 
-    def _build_query(self, **kwargs):
-        """Assemlbe the query string to be passed to the engine"""
+    def _export_results(self):
+        """Export the query results to columnar files, see
+        DbConnection.export_results()"""
 
-        filter_str =[]
-        comp_list = (self.var_collection[keys][3].get() for keys in self.var_collection)
-        ors = [i for i, j in enumerate(comp_list) if j == "OR"]
-        for i in range(len(self.var_collection)):
-            if i in ors:
-                if i-1 not in ors:
-                    lead = "or_("
-                else:
-                    lead = ""
-                if i in ors:
-                    tail = ""
-                else:
-                    tail = ")"
-            else:
-                lead = ""
-                if i-1 in ors:
-                    tail = ")"
-                else:
-                    tail = ""
-            if self.var_collection[i+2][1].get() == "IN":
-                center = "{0}.in_(['{1}'])".format(
-                   self.filter_fields[self.var_collection[i+2][0].get()],
-                   "', '".join(self.var_collection[i+2][2].get().split(", ")))
-            elif self.var_collection[i+2][1].get() == "NOT IN":
-                center = "~{0}.in_(['{1}'])".format(
-                  self.filter_fields[ self.var_collection[i+2][0].get()],
-                   "', '".join(self.var_collection[i+2][2].get().split(", ")))
-            elif self.var_collection[i+2][1].get() == "LIKE":
-                center = "{0}.like('%{1}%')".format(
-                   self.filter_fields[self.var_collection[i+2][0].get()],
-                   self.var_collection[i+2][2].get())
-            else:
-                center = "{0} {1} '{2}'".format(
-                   self.filter_fields[self.var_collection[i+2][0].get()],
-                   self.var_collection[i+2][1].get(),
-                   self.var_collection[i+2][2].get())
+        directory = tkfd.askdirectory(title="Export results to...")
+        if not directory:
+            return
+        try:
+            paths = self.conn.export_results(self._build_query(), directory,
+                columns=_parse_columns(self.cols.get()),
+                since=self._period_start())
+        except DbError as e:
+            tkMessageBox.showerror("Export error", e)
+            return
+        tkMessageBox.showinfo("Export finished",
+            "Results saved to\n{0}".format("\n".join(sorted(paths.values()))))
+
+    def _period_start(self):
+        """Return the start date of the chosen period, or None."""
 
-            filter_str.append("{0}{1}{2}".format(
-                    lead, center, tail))
+        period = self.periods[self.period.get()]
+        if period == "run":
+            return self.conn.session.query(sa.func.max(Res.date)).scalar()
+        if period:
+            # Whole days, so that repeated queries hit the result cache
+            return datetime.datetime.combine(datetime.date.today() -
+                datetime.timedelta(days=period), datetime.time())
+        return None
 
-        return ", ".join(filter_str)
+    def _build_query(self, **kwargs):
+        """Assemble the filter string to be passed to the engine, see
+        parse_filter(). Criteria joined by OR are grouped in parentheses."""
+
+        groups = [[]]
+        for i in range(len(self.var_collection)):
+            field, comp, value, cupola = [var.get() for var in
+                self.var_collection[i+2]]
+            if self.filter_fields.get(field) is not None:
+                groups[-1].append(_filter_criterion(
+                    self.filter_fields[field], comp, value))
+            if cupola != "OR" and groups[-1]:
+                groups.append([])
+        terms = []
+        for group in groups:
+            if len(group) > 1:
+                terms.append("({0})".format(" OR ".join(group)))
+            elif group:
+                terms.append(group[0])
+        return " AND ".join(terms)
 
 
     def _get_preview(self, kwargs):
         query_line = self._build_query(**kwargs)
         new_query = tkSimpleDialog.askstring("Modify query",
-            "Modify the query.\nUse SQLAlchemy syntax",
+            "Modify the query.\nCombine criteria like\n" +
+            "Cpd.name IN ('a', 'b') with AND and OR.",
             initialvalue=query_line)
         print ( new_query )
         if new_query:
@@ -1749,6 +3611,7 @@ class RtnMenu():
                 for keys in values["data_fields"]:
                     col = Column(keys, values["data_fields"][keys])
                     col.create(self.conn.metadata.tables[db])
+                self.conn.schema_changed()
 
             except(sa.InvalidRequestError, e ):
                 print ("Could not update the routine: \n\n{0}".format(e))
@@ -1787,7 +3650,7 @@ class RtnMenu():
 
     def _update_fields(self):
 
-        self.conn.metadata.reflect(self.conn.engine)
+        self.conn.refresh_schema()
         name = self.form['alias'][2][0].get()
         col_names = [eval("Rtn.{0}".format(keys)) for keys in self.form]
         col_names.append(Rtn.data_fields)
@@ -1916,7 +3779,7 @@ class UsrMenu():
 
     def _update_fields(self):
 
-        self.conn.metadata.reflect(self.conn.engine)
+        self.conn.refresh_schema()
         name = self.form['usr_name'][2][0].get()
         col_names = [eval("Usr.{0}".format(keys)) for keys in self.form]
 
@@ -2039,7 +3902,7 @@ class CpdMenu():
 
     def _update_fields(self):
 
-        self.conn.metadata.reflect(self.conn.engine)
+        self.conn.refresh_schema()
         name = self.form['name'][2][0].get()
         col_names = [eval("Cpd.{0}".format(keys)) for keys in self.form]
         val = self.conn.session.query(*col_names).filter(Cpd.name == name).first()
@@ -2205,6 +4068,8 @@ $$# Make sure to provide valselfues for all the required fields
 $$# Do not change this dictionary except for the date and the sample!
 $$# (Unless you know
 $$# what you're doing)
+$$# Add "raw_file": <path of the raw data file> to skip files that were
+$$# already imported when the script is run again.
 $$meta_values = {{
 $$$"user": "{1}",
 $$$"routine": "{2}",
@@ -2223,8 +4088,9 @@ $#  ...
 $#  [res_tbl_n, meta_values_n]]
 $#
 $# where res_tbl are data frames and meta values are dicts.
-$# If large quantities of data are important, consider a generator, or limit
-$# the assays to be imported at once.
+$# If large quantities of data are important, consider a generator
+$# ("yield [res_tbl, meta_values]" instead of appending to results): every
+$# data set is then written to the database as soon as it is produced.
 $
 $return results
 
@@ -2,10 +2,57 @@
 Last updated 08.02.2016 Andreas Helfenstein
 """
 
+import sys
+import pandas
+import pytest
 import screening_mgmt as sm
 import aux_func as af
 reload(sm)
 
+def _routine_db(tmpdir, alias, path=None, **fields):
+    """Return a database with the user 'testname' and the routine alias,
+    in memory or in the file path in tmpdir. Routine tables end up in the
+    shared metadata, so every test needs its own alias. fields are added
+    to the columns Sample and val."""
+    db = sm.DbConnection('sqlite', '','','',
+        str(tmpdir.join(path)) if path else '')
+    db._initialize()
+    db.new_entry(sm.Usr, {'usr_name': 'testname',
+        'working_directory': str(tmpdir)})
+    _add_routine(db, alias, **fields)
+    return db
+
+def _add_routine(db, alias, **fields):
+    fields = dict({'Sample': sm.Unicode(200), 'val': sm.Float}, **fields)
+    db.new_entry(sm.Rtn, {'alias': alias, 'author': 'testname',
+        'data_dimension': 1, 'script_path': None, 'data_fields': fields})
+    db.metadata.reflect(db.engine)
+
+def _dataset(alias):
+    df = pandas.DataFrame({'Sample': ['cpd1', 'cpd2', 'cpd1'],
+        'val': [0.1, 0.2, 0.3]})
+    meta = {'user': 'testname', 'routine': alias, 'date': '08.02.2016',
+        'active': 1}
+    return df, meta
+
+def _script(tmpdir, alias, result="sets"):
+    """Write the routine script alias.py to tmpdir. get_data() returns
+    result, an expression of the list of data sets 'sets'."""
+    tmpdir.join(alias + '.py').write(
+        "import pandas\n"
+        "def get_data(load_range=range(1, 3)):\n"
+        "    sets = [[pandas.DataFrame({'Sample': ['cpd%d' % plate],\n"
+        "        'val': [float(plate)]}), {'user': 'testname',\n"
+        "        'routine': '" + alias + "', 'date': '08.02.2016',\n"
+        "        'active': 1}] for plate in load_range]\n"
+        "    return " + result + "\n")
+
+def _samples(db, alias):
+    return sorted(name for name, in db.session.query(sm.Cpd.name)
+        .join(sm.Res, sm.Res.sample == sm.Cpd.cpd_id)
+        .join(sm.Rtn, sm.Res.routine == sm.Rtn.rtn_id)
+        .filter(sm.Rtn.alias == alias))
+
 def test_connect():
     db = sm.DbConnection('sqlite', '','','','')
     assert db.connect()
@@ -27,7 +74,397 @@ def test_new_entry():
     db.new_entry(sm.Usr, data)
     user_name = db.session.query(sm.Usr.usr_name,).all()
     assert user_name[0][0] == 'testname'
+
+def test_bulk_insert(tmpdir):
+    db = _routine_db(tmpdir, 'bulkrtn')
+    df, meta = _dataset('bulkrtn')
+    assert db._bulk_insert(df, meta) == 3
+    rows = db.conn.execute(
+        "SELECT bulkrtn.val, results.sample FROM bulkrtn "
+        "JOIN results ON results.res_id = bulkrtn.link "
+        "ORDER BY bulkrtn.val").fetchall()
+    assert [row[0] for row in rows] == [0.1, 0.2, 0.3]
+    assert rows[0][1] == rows[2][1] != rows[1][1]
     
+def test_session_rollback(tmpdir):
+    db = _routine_db(tmpdir, 'rollrtn')
+    db.session.add(sm.Cpd(db, name='cpd1'))
+    db.session.flush()
+    db.session.rollback()
+    assert db.session.query(sm.Cpd).count() == 0
+    db._bulk_insert(*_dataset('rollrtn'))
+    assert db.session.query(sm.Cpd).count() == 2
+
+def test_bulk_insert_quarantine(tmpdir):
+    db = _routine_db(tmpdir, 'qtnrtn')
+    df, meta = _dataset('qtnrtn')
+    df['val'] = df['val'].astype(object)
+    df.at[1, 'val'] = {'not': 'a number'}
+    assert db._bulk_insert(df, meta, chunk_size=2) == 2
+    assert db.conn.execute("SELECT COUNT(*) FROM qtnrtn").scalar() == 2
+    quarantined = db.conn.execute(sm.Qtn.__table__.select()).fetchall()
+    assert len(quarantined) == 1
+    assert quarantined[0].record['Sample'] == 'cpd2'
+
+def test_write_results_quarantine(tmpdir):
+    db = _routine_db(tmpdir, 'qwrtn')
+    tmpdir.join('qwrtn.py').write(
+        "import pandas\n"
+        "def get_data():\n"
+        "    return [[pandas.DataFrame({'Sample': ['cpd1', 'cpd2', 'cpd3'],\n"
+        "        'val': [0.1, {'not': 'a number'}, 0.3]}), {'user': 'testname',\n"
+        "        'routine': 'qwrtn', 'date': '08.02.2016', 'active': 1}]]\n")
+    assert db.write_results('qwrtn', str(tmpdir), chunk_size=2)
+    df_pool, _ = db.load_results("Rtn.alias == 'qwrtn'")
+    assert df_pool['qwrtn']['Sample'].tolist() == ['cpd1', 'cpd3']
+    quarantined = db.conn.execute(sm.Qtn.__table__.select()).fetchall()
+    assert [q.record['Sample'] for q in quarantined] == ['cpd2']
+
+def test_fingerprint(tmpdir):
+    db = _routine_db(tmpdir, 'rawrtn')
+    df, meta = _dataset('rawrtn')
+    raw_file = tmpdir.join('plate1.csv')
+    raw_file.write('Sample,val\n')
+    raw = db._fingerprint(str(raw_file), 'rawrtn')
+    assert not raw['ingested']
+    db._bulk_insert(df, meta, raw=raw)
+    assert db._fingerprint(str(raw_file), 'rawrtn')['ingested']
+    raw_file.write('Sample,val\ncpd1,0.1\n')
+    assert not db._fingerprint(str(raw_file), 'rawrtn')['ingested']
+
+def test_write_results_incremental(tmpdir):
+    db = _routine_db(tmpdir, 'incrtn')
+    tmpdir.join('incrtn.py').write(
+        "import pandas\n"
+        "def get_data(raw_file):\n"
+        "    return [[pandas.read_csv(raw_file), {'user': 'testname',\n"
+        "        'routine': 'incrtn', 'date': '08.02.2016', 'active': 1,\n"
+        "        'raw_file': raw_file}]]\n")
+    raw_file = tmpdir.join('plate1.csv')
+    raw_file.write('Sample,val\ncpd1,0.1\ncpd2,0.2\n')
+    active = "SELECT COUNT(*) FROM results WHERE active"
+    for _ in range(2):
+        assert db.write_results('incrtn', str(tmpdir), raw_file=str(raw_file))
+        assert db.conn.execute(active).scalar() == 2
+    raw_file.write('Sample,val\ncpd1,0.5\n')
+    assert db.write_results('incrtn', str(tmpdir), raw_file=str(raw_file))
+    assert db.conn.execute(active).scalar() == 1
+    assert db.conn.execute("SELECT COUNT(*) FROM results").scalar() == 3
+
+def test_id_cache():
+    cache = sm.IdCache(size=2)
+    cache.set('compounds', 'a', 1)
+    cache.set('compounds', 'b', 2)
+    assert cache.get('compounds', 'a') == 1
+    cache.set('users', 'a', 3)
+    assert cache.get('compounds', 'b') is None
+    assert len(cache) == 2
+    cache.invalidate('users')
+    assert cache.get('users', 'a') is None
+    assert cache.get('compounds', 'a') == 1
+
+def test_id_cache_lookups(tmpdir):
+    db = _routine_db(tmpdir, 'cachertn')
+    key = db._get_id(sm.Cpd, 'cpd1')
+    assert db._get_id(sm.Cpd, 'cpd1') == key
+    assert db.id_cache.hits == 1
+    assert db._get_id(sm.Rtn, 'unknown') is None
+
+def test_get_cpd_ids(tmpdir):
+    db = _routine_db(tmpdir, 'cpdrtn')
+    db.new_entry(sm.Cpd, {'name': 'cpd1'})
+    cpd_ids = db._get_cpd_ids(['cpd1', 'cpd2', 'cpd2', 3])
+    assert sorted(cpd_ids, key=str) == [3, 'cpd1', 'cpd2']
+    assert db.session.query(sm.Cpd).count() == 3
+    assert db._get_cpd_ids(['cpd2']) == {'cpd2': cpd_ids['cpd2']}
+
+def test_schema_cache(tmpdir):
+    db = _routine_db(tmpdir, 'schemartn')
+    version = db.schema_version
+    db.refresh_schema()
+    assert db._reflected_version == version
+    db.conn.execute("CREATE TABLE external (id INTEGER PRIMARY KEY)")
+    db.refresh_schema()
+    assert 'external' not in db.metadata.tables
+    db.refresh_schema(force=True)
+    assert 'external' in db.metadata.tables
+
+def test_parse_filter():
+    criterion = sm.parse_filter("Cpd.name LIKE '%ol' AND "
+        "(Usr.usr_name NOT IN ('a', 'b''c') OR Rtn.alias == 'x') OR "
+        "Res.active == 1")
+    sql = str(criterion.compile(compile_kwargs={'literal_binds': True}))
+    assert sql == ("compounds.name LIKE '%ol' AND (users.usr_name NOT IN "
+        "('a', 'b''c') OR routines.alias = 'x') OR results.active = 1")
+    assert sm._filter_criterion('Cpd.name', 'IN', "a, b") == \
+        "Cpd.name IN ('a', 'b')"
+    for filter_str in ("Cpd.name ==", "Cpd.nme == 'a'", "os.system('x')",
+            "Cpd.name == 'a' Usr.usr_name == 'b'", "(Cpd.name == 'a'"):
+        with pytest.raises(sm.DbError):
+            sm.parse_filter(filter_str)
+
+def test_load_results(tmpdir):
+    db = _routine_db(tmpdir, 'loadrtn')
+    db._bulk_insert(*_dataset('loadrtn'))
+    df_pool, dir_pool = db.load_results(
+        "Cpd.name == 'cpd1' AND Rtn.alias == 'loadrtn'")
+    assert list(df_pool['loadrtn'].columns) == ['id', 'link', 'Sample', 'val']
+    assert df_pool['loadrtn']['val'].tolist() == [0.1, 0.3]
+    assert dir_pool == {'loadrtn': str(tmpdir)}
+
+def test_load_results_routines(tmpdir):
+    db = _routine_db(tmpdir, 'usedrtn')
+    _add_routine(db, 'unusedrtn')
+    db.new_entry(sm.Usr, {'usr_name': 'other',
+        'working_directory': 'elsewhere'})
+    db._bulk_insert(*_dataset('usedrtn'))
+    queries, dir_pool = db._result_queries("Cpd.name == 'cpd1'")
+    assert [routine for routine, _ in queries] == ['usedrtn']
+    assert dir_pool == {'usedrtn': str(tmpdir)}
+
+def test_load_results_columns(tmpdir):
+    db = _routine_db(tmpdir, 'colrtn')
+    db._bulk_insert(*_dataset('colrtn'))
+    columns = sm._parse_columns("colrtn: val; other: a, b")
+    assert columns == {'colrtn': ['val'], 'other': ['a', 'b']}
+    df_pool, _ = db.load_results("Rtn.alias == 'colrtn'", columns=columns)
+    assert list(df_pool['colrtn'].columns) == ['link', 'val']
+    with pytest.raises(sm.DbError):
+        db.load_results("Rtn.alias == 'colrtn'", columns={'colrtn': ['x']})
+
+def test_load_results_dates(tmpdir):
+    db = _routine_db(tmpdir, 'datertn')
+    df, meta = _dataset('datertn')
+    db._bulk_insert(df, meta)
+    meta['date'] = '2017-03-01'
+    db._bulk_insert(df, meta)
+    df_pool, _ = db.load_results("Cpd.name == 'cpd1'", since='2017-01-01')
+    assert df_pool['datertn']['link'].tolist() == [4, 6]
+    df_pool, _ = db.load_results("", until='2017-01-01')
+    assert df_pool['datertn']['link'].tolist() == [1, 2, 3]
+    df_pool, _ = db.load_results("Res.date >= '2017-03-01'")
+    assert len(df_pool['datertn']) == 3
+    with pytest.raises(sm.DbError):
+        db.load_results("Res.date >= 'soon'")
+
+def test_load_results_compact(tmpdir):
+    db = _routine_db(tmpdir, 'typedrtn')
+    db._bulk_insert(*_dataset('typedrtn'))
+    df = db.load_results("", compact=True)[0]['typedrtn']
+    assert str(df['Sample'].dtype) == 'category'
+    assert df['link'].dtype == 'int8'
+    assert df['val'].dtype == 'float64'
+    df = sm.compact_frame(pandas.DataFrame({'a': [0.5, 1.0, None],
+        'b': ['x', 'y', 'z']}))
+    assert df['a'].dtype == 'float32'
+    assert str(df['b'].dtype) != 'category'
+
+def test_load_results_workers(tmpdir):
+    db = _routine_db(tmpdir, 'parrtn1', 'par.db')
+    _add_routine(db, 'parrtn2')
+    for alias in ('parrtn1', 'parrtn2'):
+        db._bulk_insert(*_dataset(alias))
+    parallel, _ = db.load_results("Cpd.name == 'cpd1'", workers=2)
+    db.result_cache.clear()
+    sequential, _ = db.load_results("Cpd.name == 'cpd1'", workers=1)
+    assert sorted(parallel) == ['parrtn1', 'parrtn2']
+    for routine in parallel:
+        assert parallel[routine].equals(sequential[routine])
+
+def test_iter_results(tmpdir):
+    db = _routine_db(tmpdir, 'iterrtn')
+    db._bulk_insert(*_dataset('iterrtn'))
+    chunks = list(db.iter_results("Rtn.alias == 'iterrtn'", chunk_size=2))
+    assert [len(df) for _, df, _ in chunks] == [2, 1]
+    assert chunks[0][0] == 'iterrtn'
+    assert chunks[0][2] == str(tmpdir)
+    assert list(chunks[1][1].columns) == ['id', 'link', 'Sample', 'val']
+
+def test_result_cache(tmpdir):
+    db = _routine_db(tmpdir, 'resrtn')
+    db._bulk_insert(*_dataset('resrtn'))
+    db.load_results("Rtn.alias == 'resrtn'")
+    assert len(db.result_cache) == 0
+    db.result_cache = sm.ResultCache(max_bytes=2**20,
+        directory=str(tmpdir.join('c')))
+    df_pool, _ = db.load_results("Rtn.alias == 'resrtn'")
+    # Room for exactly one entry
+    db.result_cache.max_bytes = db.result_cache.nbytes
+    df_pool['resrtn']['val'] = 0
+    df_pool, _ = db.load_results(" Rtn.alias=='resrtn' ")
+    assert db.result_cache.hits == 1
+    assert df_pool['resrtn']['val'].tolist() == [0.1, 0.2, 0.3]
+    db.load_results("Usr.usr_name == 'testname'")
+    assert len(tmpdir.join('c').listdir()) == 1
+    db.load_results("Rtn.alias == 'resrtn'")
+    assert db.result_cache.hits == 2
+    db._bulk_insert(*_dataset('resrtn'))
+    df_pool, _ = db.load_results("Rtn.alias == 'resrtn'")
+    assert len(df_pool['resrtn']) == 6
+    assert db.result_cache.hits == 2
+
+def test_result_cache_new_rows(tmpdir):
+    db = _routine_db(tmpdir, 'cachertn1')
+    _add_routine(db, 'cachertn2')
+    db.result_cache.max_bytes = 2**20
+    db._bulk_insert(*_dataset('cachertn1'))
+    df_pool, _ = db.load_results("Cpd.name == 'cpd1'")
+    assert list(df_pool) == ['cachertn1']
+    db._bulk_insert(*_dataset('cachertn2'))
+    df_pool, _ = db.load_results("Cpd.name == 'cpd1'")
+    assert sorted(df_pool) == ['cachertn1', 'cachertn2']
+
+def test_aggregate_results(tmpdir):
+    db = _routine_db(tmpdir, 'aggrtn')
+    db._bulk_insert(*_dataset('aggrtn'))
+    df = db.aggregate_results("", 'aggrtn')
+    assert list(df.columns) == ['compound', 'val_mean', 'val_sd', 'val_n']
+    assert df['compound'].tolist() == ['cpd1', 'cpd2']
+    assert df['val_n'].tolist() == [2, 1]
+    assert abs(df['val_mean'][0] - 0.2) < 1e-9
+    assert abs(df['val_sd'][0] - 0.02 ** 0.5) < 1e-9
+    assert pandas.isnull(df['val_sd'][1])
+    df = db.aggregate_results("Cpd.name == 'cpd2'", 'aggrtn', ['val'],
+        by=('compound', 'user'))
+    assert df[['compound', 'user']].values.tolist() == [['cpd2', 'testname']]
+
+def test_aggregate_results_sd(tmpdir):
+    db = _routine_db(tmpdir, 'sdrtn')
+    df = pandas.DataFrame({'Sample': ['cpd1'] * 4,
+        'val': [1e8 + 0.1, 1e8 + 0.2, 1e8 + 0.3, 1e8 + 0.4]})
+    db._bulk_insert(df, _dataset('sdrtn')[1])
+    df = db.aggregate_results("", 'sdrtn')
+    assert abs(df['val_sd'][0] - 0.1291) < 1e-4
+
+def test_ensure_indexes(tmpdir):
+    db = _routine_db(tmpdir, 'idxrtn')
+    assert db.ensure_indexes() == []
+    db.conn.execute("DROP INDEX ix_results_sample")
+    db.conn.execute("DROP INDEX ix_idxrtn_link")
+    db.conn.execute("DROP INDEX ix_raw_data_path")
+    assert sorted(db.ensure_indexes()) == ['ix_idxrtn_link',
+        'ix_raw_data_path', 'ix_results_sample']
+    assert db.ensure_indexes() == []
+
+def test_export_results(tmpdir):
+    pytest.importorskip('pyarrow')
+    db = _routine_db(tmpdir, 'exprtn')
+    db._bulk_insert(*_dataset('exprtn'))
+    paths = db.export_results("Rtn.alias == 'exprtn'", str(tmpdir.join('x')),
+        chunk_size=2)
+    assert paths == {'exprtn': str(tmpdir.join('x', 'exprtn.arrow'))}
+    df = sm.read_export(paths['exprtn'])
+    assert df.equals(db.load_results("Rtn.alias == 'exprtn'")[0]['exprtn'])
+    assert df.attrs['routine'] == 'exprtn'
+    df = sm.read_export(paths['exprtn'], columns=['val'])
+    assert df['val'].tolist() == [0.1, 0.2, 0.3]
+
+def test_export_results_null_chunk(tmpdir):
+    pytest.importorskip('pyarrow')
+    db = _routine_db(tmpdir, 'expnullrtn', note=sm.Unicode(20),
+        count=sm.Integer)
+    df = pandas.DataFrame({'Sample': ['cpd1'] * 6, 'val': [0.1] * 6,
+        'note': [None, None, None, 'x', 'y', 'z'], 'count': [None] * 6})
+    db._bulk_insert(df, _dataset('expnullrtn')[1])
+    paths = db.export_results("Rtn.alias == 'expnullrtn'", str(tmpdir),
+        chunk_size=2)
+    df = sm.read_export(paths['expnullrtn'])
+    assert df['note'].tolist()[3:] == ['x', 'y', 'z']
+    assert df['note'].isnull().sum() == 3
+
+def test_routine_registry(tmpdir):
+    registry = sm.RoutineRegistry()
+    script = tmpdir.join('regrtn.py')
+    script.write("def get_data():\n    return 1\n")
+    path = list(sys.path)
+    rtn = registry.get('regrtn', str(tmpdir))
+    assert rtn.get_data() == 1
+    assert registry.get('regrtn', str(tmpdir)) is rtn
+    script.setmtime(script.mtime() + 10)
+    assert registry.get('regrtn', str(tmpdir)) is rtn
+    script.write("def get_data():\n    return 22\n")
+    assert registry.get('regrtn', str(tmpdir)).get_data() == 22
+    assert sys.path == path
+    with pytest.raises(ImportError):
+        registry.get('missing', str(tmpdir))
+
+def test_render_plots(tmpdir):
+    pytest.importorskip('matplotlib')
+    db = _routine_db(tmpdir, 'plotrtn')
+    tmpdir.join('plotrtn.py').write(
+        "def summarize_plot(data, *args, **kwargs):\n"
+        "    return data.plot(x='link', y='val', kind='bar')\n")
+    tmpdir.join('noplotrtn.py').write("")
+    db._bulk_insert(*_dataset('plotrtn'))
+    results, dirs = db.load_results("Rtn.alias == 'plotrtn'")
+    results['noplotrtn'] = results['plotrtn']
+    dirs['noplotrtn'] = str(tmpdir)
+    paths = db.render_plots(results, dirs, str(tmpdir.join('out')), 2)
+    assert list(paths) == ['plotrtn']
+    assert tmpdir.join('out').join(paths['plotrtn'].split('/')[-1]).size()
+
+def test_write_results_generator(tmpdir):
+    db = _routine_db(tmpdir, 'genrtn')
+    _script(tmpdir, 'genrtn', "(dataset for dataset in sets)")
+    assert db.write_results('genrtn', str(tmpdir), load_range=range(1, 4))
+    assert _samples(db, 'genrtn') == ['cpd1', 'cpd2', 'cpd3']
+
+def test_write_results_list(tmpdir):
+    db = _routine_db(tmpdir, 'listrtn')
+    _script(tmpdir, 'listrtn')
+    assert db.write_results('listrtn', str(tmpdir))
+    assert _samples(db, 'listrtn') == ['cpd1', 'cpd2']
+
+def test_write_results_workers(tmpdir):
+    db = _routine_db(tmpdir, 'wrkrtn')
+    _script(tmpdir, 'wrkrtn')
+    # More shards than the workers have pending at a time
+    assert db.write_results('wrkrtn', str(tmpdir), workers=2,
+        load_range=range(1, 21))
+    assert _samples(db, 'wrkrtn') == sorted('cpd%d' % i for i in range(1, 21))
+
+def test_write_results_sqlite_profile(tmpdir):
+    db = _routine_db(tmpdir, 'profrtn', 'prof.db')
+    _script(tmpdir, 'profrtn')
+    pragmas = [db.conn.execute("PRAGMA " + name).scalar()
+        for name in ('journal_mode', 'synchronous')]
+    assert db.write_results('profrtn', str(tmpdir), sqlite_profile=True)
+    assert _samples(db, 'profrtn') == ['cpd1', 'cpd2']
+    assert [db.conn.execute("PRAGMA " + name).scalar()
+        for name in ('journal_mode', 'synchronous')] == pragmas
+
+def test_submit_results(tmpdir):
+    db = _routine_db(tmpdir, 'jobrtn', 'jobs.db')
+    tmpdir.join('jobrtn.py').write(
+        "import pandas\n"
+        "def get_data(plates=2):\n"
+        "    for plate in range(plates):\n"
+        "        yield [pandas.DataFrame({'Sample': ['cpd1', 'cpd2'],\n"
+        "            'val': [0.1, 0.2]}), {'user': 'testname',\n"
+        "            'routine': 'jobrtn', 'date': '08.02.2016', 'active': 1}]\n"
+        "    yield 'not a data set'\n")
+    job = db.submit_results('jobrtn', str(tmpdir), plates=3)
+    assert job.wait(30)
+    assert job.done
+    assert (job.datasets, job.rows) == (3, 6)
+    assert len(job.errors) == 1
+    db.refresh_schema(force=True)
+    assert db.session.query(sm.Res).count() == 6
+
+def test_get_data_errors(tmpdir):
+    db = _routine_db(tmpdir, 'jobrtn2', 'joberr.db')
+    _script(tmpdir, 'jobrtn2')
+    tmpdir.join('brokenrtn.py').write(
+        "def get_data():\n"
+        "    return None + 1\n")
+    for args in (('jobrtn2', {'plates': 3}), ('brokenrtn', {})):
+        job = db.submit_results(args[0], str(tmpdir), **args[1])
+        assert job.wait(30)
+        assert job.datasets == 0
+        assert len(job.errors) == 1
+        with pytest.raises(TypeError):
+            db.write_results(args[0], str(tmpdir), **args[1])
+
 # Testing auxiliary functions
 
 def test_sm_shorten_name():